@@ -0,0 +1,323 @@
+"""
+banded_mvn: compiled multivariate normal routines for banded covariance matrices, without SciPy
+
+Banded symmetric matrix A with bandwidth p is stored in lower band form: A_band[d, i] = A[i + d, i] for d = 0, ..., p
+(same as scipy.linalg.cholesky_banded with lower=True); entries past the end of the matrix are ignored.
+"""
+
+from __future__ import annotations
+
+import math
+import numpy as np
+from numba import njit, prange
+
+from typing import Any, Tuple, Optional
+from nptyping import NDArray
+
+
+LOG_SQRT_2PI = 0.918938533204672741
+SQRT_2PI = 2.506628274631000502
+SQRT_2 = 1.414213562373095049
+
+
+def to_band(A: NDArray, p: Optional[int] = None) -> NDArray:
+    """Lower band form of symmetric or lower triangular matrix A with bandwidth p (full by default). Works on stacked
+    matrices (..., M, M) as well, returning (..., p + 1, M)"""
+    M = A.shape[-1]
+    p = M - 1 if p is None else p
+    A_band = np.zeros(A.shape[:-2] + (p + 1, M))
+    for d in range(p + 1):
+        A_band[..., d, : M - d] = np.diagonal(A, offset=-d, axis1=-2, axis2=-1)
+    return A_band
+
+
+@njit(cache=True)
+def mvn_mu_Sigma_band(
+    n_vec: NDArray[(Any,), float], C_mat: NDArray[(Any, Any), float], Xi_mat: NDArray[(Any, Any), float], L: int, N: int
+) -> Tuple[NDArray[(Any,), float], NDArray[(Any, Any), float]]:
+    """Same as RandomizedIrEffect.mvn_mu_Sigma_as_func_of_n_vec, but Sigma is assembled directly in lower band form
+
+    See \\ref{eq:Xi-matrix-for-Sigma-calculation}"""
+    mu = C_mat @ n_vec
+    M = N - L
+    Sigma_band = np.zeros((L + 1, M))
+    for i_cut in range(M):
+        Sigma_i_vec = Xi_mat @ n_vec[i_cut : i_cut + L + 1]  # noqa
+        for d in range(min(L + 1, M - i_cut)):
+            Sigma_band[d, i_cut] = Sigma_i_vec[d]
+    return mu, Sigma_band
+
+
+@njit(cache=True)
+def cholesky_band(A_band: NDArray[(Any, Any), float]) -> Tuple[NDArray[(Any, Any), float], bool]:
+    """Cholesky factorization A = G @ G.T of banded matrix in O(M * p^2); G is returned in lower band form.
+    Second returned value is False if A is not positive definite."""
+    p = A_band.shape[0] - 1
+    M = A_band.shape[1]
+    G_band = np.zeros_like(A_band)
+    for j in range(M):
+        s = A_band[0, j]
+        for k in range(max(0, j - p), j):
+            s -= G_band[j - k, k] ** 2
+        if s <= 0:
+            return G_band, False
+        G_jj = np.sqrt(s)
+        G_band[0, j] = G_jj
+        for i in range(j + 1, min(M, j + p + 1)):
+            s = A_band[i - j, j]
+            for k in range(max(0, i - p), j):
+                s -= G_band[i - k, k] * G_band[j - k, k]
+            G_band[i - j, j] = s / G_jj
+    return G_band, True
+
+
+@njit(cache=True)
+def solve_lower_band(G_band: NDArray[(Any, Any), float], r: NDArray[(Any,), float]) -> NDArray[(Any,), float]:
+    """Solve G @ y = r for y by forward substitution, G is lower triangular in band form"""
+    p = G_band.shape[0] - 1
+    M = G_band.shape[1]
+    y = np.empty(M)
+    for i in range(M):
+        s = r[i]
+        for k in range(max(0, i - p), i):
+            s -= G_band[i - k, k] * y[k]
+        y[i] = s / G_band[0, i]
+    return y
+
+
+@njit(cache=True)
+def solve_upper_band_transposed(
+    G_band: NDArray[(Any, Any), float], y: NDArray[(Any,), float]
+) -> NDArray[(Any,), float]:
+    """Solve G.T @ z = y for z by backward substitution, G is lower triangular in band form"""
+    p = G_band.shape[0] - 1
+    M = G_band.shape[1]
+    z = np.empty(M)
+    for i in range(M - 1, -1, -1):
+        s = y[i]
+        for k in range(i + 1, min(M, i + p + 1)):
+            s -= G_band[k - i, i] * z[k]
+        z[i] = s / G_band[0, i]
+    return z
+
+
+@njit(cache=True)
+def inverse_in_band(G_band: NDArray[(Any, Any), float]) -> NDArray[(Any, Any), float]:
+    """Entries of (G @ G.T)^-1 inside the band of G @ G.T, in lower band form, by Takahashi recursion in O(M * p^2).
+    Full inverse is dense, but only these entries are needed for gradients of the log-determinant."""
+    p = G_band.shape[0] - 1
+    M = G_band.shape[1]
+    Z_band = np.zeros_like(G_band)
+    # column j of Z @ G = G^-T has 1 / G_jj on the diagonal and zeros below it
+    for j in range(M - 1, -1, -1):
+        i_max = min(M - 1, j + p)
+        for i in range(i_max, j - 1, -1):
+            s = 1 / G_band[0, j] if i == j else 0.0
+            for k in range(j + 1, i_max + 1):
+                Z_ik = Z_band[i - k, k] if i >= k else Z_band[k - i, i]
+                s -= Z_ik * G_band[k - j, j]
+            Z_band[i - j, j] = s / G_band[0, j]
+    return Z_band
+
+
+@njit(cache=True)
+def logpdf_factorized(x: NDArray[(Any,), float], mu: NDArray[(Any,), float], G_band: NDArray[(Any, Any), float]):
+    """Log-density of N(mu, G @ G.T) at x given Cholesky factor in band form"""
+    y = solve_lower_band(G_band, x - mu)
+    return -0.5 * np.sum(y ** 2) - np.sum(np.log(G_band[0, :])) - x.size * LOG_SQRT_2PI
+
+
+@njit(cache=True)
+def logpdf(x: NDArray[(Any,), float], mu: NDArray[(Any,), float], Sigma_band: NDArray[(Any, Any), float]) -> float:
+    """Log-density of N(mu, Sigma) at x, Sigma in lower band form. -inf if Sigma is not positive definite"""
+    G_band, is_positive_definite = cholesky_band(Sigma_band)
+    if not is_positive_definite:
+        return -np.inf
+    return logpdf_factorized(x, mu, G_band)
+
+
+@njit(cache=True)
+def logpdf_value_and_grad(
+    x: NDArray[(Any,), float], mu: NDArray[(Any,), float], Sigma_band: NDArray[(Any, Any), float]
+) -> Tuple[float, NDArray[(Any,), float], NDArray[(Any, Any), float]]:
+    """logpdf together with its gradients w.r.t. mu and Sigma_band. Off-diagonal entries of Sigma_band are treated as
+    single parameters setting both symmetric entries of Sigma. Value is -inf and gradients are zero if Sigma is not
+    positive definite."""
+    grad_mu = np.zeros_like(mu)
+    grad_Sigma_band = np.zeros_like(Sigma_band)
+    G_band, is_positive_definite = cholesky_band(Sigma_band)
+    if not is_positive_definite:
+        return -np.inf, grad_mu, grad_Sigma_band
+    y = solve_lower_band(G_band, x - mu)
+    value = -0.5 * np.sum(y ** 2) - np.sum(np.log(G_band[0, :])) - x.size * LOG_SQRT_2PI
+    alpha = solve_upper_band_transposed(G_band, y)  # Sigma^-1 (x - mu)
+    Z_band = inverse_in_band(G_band)
+    grad_mu[:] = alpha
+    p = Sigma_band.shape[0] - 1
+    M = Sigma_band.shape[1]
+    # d logpdf / d Sigma = (alpha alpha^T - Sigma^-1) / 2
+    for c in range(M):
+        for d in range(min(p + 1, M - c)):
+            symmetric_factor = 0.5 if d == 0 else 1.0
+            grad_Sigma_band[d, c] = symmetric_factor * (alpha[c + d] * alpha[c] - Z_band[d, c])
+    return value, grad_mu, grad_Sigma_band
+
+
+# Genz-Keane-Hajivassiliou (GHK) box probability estimation
+
+# coefficients of Acklam's rational approximation, highest power first
+PPF_CENTRAL_NUMERATOR = np.array(
+    [
+        -3.969683028665376e01,
+        2.209460984245205e02,
+        -2.759285104469687e02,
+        1.383577518672690e02,
+        -3.066479806614716e01,
+        2.506628277459239e00,
+    ]
+)
+PPF_CENTRAL_DENOMINATOR = np.array(
+    [
+        -5.447609879822406e01,
+        1.615858368580409e02,
+        -1.556989798598866e02,
+        6.680131188771972e01,
+        -1.328068155288572e01,
+        1.0,
+    ]
+)
+PPF_TAIL_NUMERATOR = np.array(
+    [
+        -7.784894002430293e-03,
+        -3.223964580411365e-01,
+        -2.400758277161838e00,
+        -2.549732539343734e00,
+        4.374664141464968e00,
+        2.938163982698783e00,
+    ]
+)
+PPF_TAIL_DENOMINATOR = np.array(
+    [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e00, 3.754408661907416e00, 1.0]
+)
+
+
+@njit(cache=True)
+def _polyval(coeffs: NDArray[(Any,), float], x: float) -> float:
+    result = 0.0
+    for c in coeffs:
+        result = result * x + c
+    return result
+
+
+@njit(cache=True)
+def _norm_ppf_lower_tail(q: float) -> float:
+    r = np.sqrt(-2 * np.log(q))
+    return _polyval(PPF_TAIL_NUMERATOR, r) / _polyval(PPF_TAIL_DENOMINATOR, r)
+
+
+@njit(cache=True)
+def norm_ppf(q: float) -> float:
+    """Inverse standard normal CDF: Acklam's rational approximation refined with one Halley step"""
+    if q <= 0.0:
+        return -np.inf
+    if q >= 1.0:
+        return np.inf
+    q_low = 0.02425
+    if q < q_low:
+        x = _norm_ppf_lower_tail(q)
+    elif q > 1 - q_low:
+        x = -_norm_ppf_lower_tail(1 - q)
+    else:
+        r = q - 0.5
+        t = r * r
+        x = r * _polyval(PPF_CENTRAL_NUMERATOR, t) / _polyval(PPF_CENTRAL_DENOMINATOR, t)
+    # Halley refinement
+    e = 0.5 * math.erfc(-x / SQRT_2) - q
+    u = e * SQRT_2PI * np.exp(0.5 * x * x)
+    return x - u / (1 + 0.5 * x * u)
+
+
+@njit(cache=True)
+def truncated_norm_interval(a: float, b: float, u: float) -> Tuple[float, float]:
+    """Probability of standard normal to fall in [a, b] and its quantile u conditional on being there. Tail side is
+    chosen so that narrow intervals far from zero don't lose precision."""
+    if a >= 0:
+        # both bounds in upper tail, working with survival function
+        Q_a = 0.5 * math.erfc(a / SQRT_2)
+        Q_b = 0.5 * math.erfc(b / SQRT_2)
+        p = Q_a - Q_b
+        return p, -norm_ppf(Q_a - u * p)
+    else:
+        Phi_a = 0.5 * math.erfc(-a / SQRT_2)
+        Phi_b = 0.5 * math.erfc(-b / SQRT_2)
+        p = Phi_b - Phi_a
+        return p, norm_ppf(Phi_a + u * p)
+
+
+@njit(cache=True)
+def ghk_log_box_probability_factorized(
+    lower: NDArray[(Any,), float],
+    upper: NDArray[(Any,), float],
+    mu: NDArray[(Any,), float],
+    G_band: NDArray[(Any, Any), float],
+    uniforms: NDArray[(Any, Any), float],
+) -> float:
+    """GHK (sequential conditioning) estimate of log P(lower <= X <= upper) for X ~ N(mu, G @ G.T) with Cholesky
+    factor in band form. Each row of uniforms (n_samples, M) drives one sequential sample; passing the same uniforms
+    gives common random numbers across calls. Cost is O(n_samples * M * p)."""
+    p = G_band.shape[0] - 1
+    M = mu.size
+    n_samples = uniforms.shape[0]
+    e = np.empty(M)
+    log_probs = np.empty(n_samples)
+    for k in range(n_samples):
+        log_p = 0.0
+        for i in range(M):
+            conditional_mean = mu[i]
+            for j in range(max(0, i - p), i):
+                conditional_mean += G_band[i - j, j] * e[j]
+            a_i = (lower[i] - conditional_mean) / G_band[0, i]
+            b_i = (upper[i] - conditional_mean) / G_band[0, i]
+            p_i, e[i] = truncated_norm_interval(a_i, b_i, uniforms[k, i])
+            if p_i <= 0:
+                log_p = -np.inf
+                break
+            log_p += np.log(p_i)
+        log_probs[k] = log_p
+    # log of mean probability, avoiding underflow
+    log_p_max = np.max(log_probs)
+    if np.isinf(log_p_max):
+        return -np.inf
+    return log_p_max + np.log(np.mean(np.exp(log_probs - log_p_max)))
+
+
+@njit(cache=True)
+def ghk_log_box_probability(
+    lower: NDArray[(Any,), float],
+    upper: NDArray[(Any,), float],
+    mu: NDArray[(Any,), float],
+    Sigma_band: NDArray[(Any, Any), float],
+    uniforms: NDArray[(Any, Any), float],
+) -> float:
+    """See ghk_log_box_probability_factorized; Sigma in lower band form, -inf if it is not positive definite"""
+    G_band, is_positive_definite = cholesky_band(Sigma_band)
+    if not is_positive_definite:
+        return -np.inf
+    return ghk_log_box_probability_factorized(lower, upper, mu, G_band, uniforms)
+
+
+@njit(parallel=True, cache=True)
+def ghk_log_box_probability_batch(
+    lower: NDArray[(Any,), float],
+    upper: NDArray[(Any,), float],
+    mus: NDArray[(Any, Any), float],
+    Sigma_bands: NDArray[(Any, Any, Any), float],
+    uniforms: NDArray[(Any, Any), float],
+) -> NDArray[(Any,), float]:
+    """ghk_log_box_probability for a batch of distributions sharing the same box, e.g. one per MCMC walker.
+    mus are stacked as (W, M), Sigma_bands as (W, p + 1, M); distributions are processed in parallel."""
+    W = mus.shape[0]
+    log_probs = np.empty(W)
+    for w in prange(W):
+        log_probs[w] = ghk_log_box_probability(lower, upper, mus[w], Sigma_bands[w], uniforms)
+    return log_probs
@@ -2,6 +2,8 @@
 Fitting signal arrival times with plane EAS front (bonus: adaptive point exclusion)
 """
 
+from __future__ import annotations
+
 import numpy as np
 from scipy.optimize import curve_fit
 from numba import njit
@@ -70,39 +72,44 @@ def adaptive_excluding_fit(
     return popt, perr, in_fit_mask
 
 
+@njit(cache=True)
+def axis_position_logprior(ax_x_y: NDArray, max_ch_r: float) -> float:
+    r = np.sqrt(np.sum(ax_x_y ** 2))
+    return 0 if r < 3 * max_ch_r else -np.inf
+
+
+@njit(cache=True)
+def axis_position_loglike(ax_x_y: NDArray, ch_x_y: NDArray, n_mean: NDArray, n_disp: NDArray) -> float:
+    r = np.sqrt(np.sum((ch_x_y - ax_x_y) ** 2, axis=1))
+    sort_is = np.argsort(r)  # sorting from shower axis to the side
+    r = r[sort_is]
+    n_mean_ = n_mean[sort_is]
+    n_disp_ = n_disp[sort_is]
+
+    logp = 0.0
+    for i in range(ch_x_y.shape[0]):
+        for j in range(i + 1, ch_x_y.shape[0]):
+            # P(i>j)
+            mu = n_mean_[i] - n_mean_[j]
+            sigma = np.sqrt(n_disp_[i] + n_disp_[j])
+            logp += np.log(1 - norm_cdf(np.array([0.0]), mu=mu, sigma=sigma))[0]
+
+    return logp
+
+
 def get_axis_position_logprior_and_loglike(x, y, n_mean, n_std):
     ch_x_y = np.concatenate((np.expand_dims(x, 1), np.expand_dims(y, 1)), axis=1)
 
     max_ch_r = np.max(np.sqrt(np.sum(ch_x_y ** 2, axis=1)))
 
-    n_disp = n_std ** 2
-    N_pts = len(x)
+    n_mean = np.asarray(n_mean, dtype=float)
+    n_disp = np.asarray(n_std, dtype=float) ** 2
 
-    @njit
     def logprior(ax_x_y):
-        r = np.sqrt(np.sum(ax_x_y ** 2))
-        return 0 if r < 3 * max_ch_r else -np.inf
+        return axis_position_logprior(ax_x_y, max_ch_r)
 
-    @njit
     def loglike(ax_x_y):
-        r = np.sqrt(np.sum((ch_x_y - ax_x_y) ** 2, axis=1))
-        sort_is = np.argsort(r)  # sorting from shower axis to the side
-        r = r[sort_is]
-        n_mean_ = n_mean[sort_is]
-        n_disp_ = n_disp[sort_is]
-
-        # @njit
-        def is_greater_prob(i, j):  # P(i>j)
-            mu = n_mean_[i] - n_mean_[j]
-            sigma = np.sqrt(n_disp_[i] + n_disp_[j])
-            return 1 - norm_cdf(np.array([0.0]), mu=mu, sigma=sigma)
-
-        logp = 0.0
-        for i in range(N_pts):
-            for j in range(i + 1, N_pts):
-                logp += np.log(is_greater_prob(i, j))[0]
-
-        return logp
+        return axis_position_loglike(ax_x_y, ch_x_y, n_mean, n_disp)
 
     return logprior, loglike
 
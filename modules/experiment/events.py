@@ -2,11 +2,13 @@
 Experimental data reading and processing
 """
 
+from __future__ import annotations
+
 import numpy as np
 from pathlib import Path
 from tqdm import tqdm
 
-from typing import Any, Tuple, Optional, Literal
+from typing import Any, Tuple, Optional, Literal, Dict, Sequence
 from nptyping import NDArray
 
 from modules.experiment.rir import get_rireffs
@@ -155,6 +157,7 @@ class EventProcessor:
     DECONV_RESULTS_DIR = TEMP_DATA_DIR / 'deconvolution-results'
     SIGREC_DIR = TEMP_DATA_DIR / 'signal-reconstruction'
     EAS_PARAMS_DIR = TEMP_DATA_DIR / 'eas-geometry'
+    RIREFF_CACHE_DIR = TEMP_DATA_DIR / 'rireff-cache'
 
     def __init__(
         self,
@@ -163,13 +166,26 @@ class EventProcessor:
         preliminary_run_length: int = 10 ** 4,
         load_rir: bool = True,
         min_signal_significance: float = 4.0,
+        rir_samplesize: Optional[int] = None,
+        sampling_backend: str = 'emcee',
+        deconvolution_mode: str = 'mcmc',
     ):
+        if sampling_backend not in {'emcee', 'nuts'}:
+            raise ValueError(f"Unknown sampling backend '{sampling_backend}'")
+        # 'mcmc' for full posterior sampling or 'laplace' for quick-look normal approximation around posterior mode
+        if deconvolution_mode not in {'mcmc', 'laplace'}:
+            raise ValueError(f"Unknown deconvolution mode '{deconvolution_mode}'")
         self.verbosity = verbosity
+        self.sampling_backend = sampling_backend
+        self.deconvolution_mode = deconvolution_mode
         self.N = N
         self.preliminary_run_length = preliminary_run_length
         self.min_signal_significance = min_signal_significance
         if load_rir:
-            self.ham_rireff, self.feu84_rireff = get_rireffs(N)
+            # sampled RIR effects are cached on disk, semi-analytic ones (rir_samplesize=None) are fast anyway
+            self.ham_rireff, self.feu84_rireff = get_rireffs(
+                N, samplesize=rir_samplesize, cache_dir=self.RIREFF_CACHE_DIR
+            )
 
     def log(self, msg: str, min_verbosity: int = 1):
         if self.verbosity >= min_verbosity:
@@ -177,6 +193,10 @@ class EventProcessor:
 
     def __call__(self, event: Event):
         self.log('\n' + '=' * 25 + '\n' + f" Processing event #{event.id_}" + '\n' + '=' * 25 + '\n')
+        pending_channels = [
+            i_ch for i_ch in range(N_CHANNELS) if not self._deconvolution_result_path(event.id_, i_ch).exists()
+        ]
+        n_vec_estimations = self._estimate_n_vecs(event, pending_channels) if pending_channels else {}
         for i_ch in range(N_CHANNELS):
 
             deconvolution_result_path = self._deconvolution_result_path(event.id_, i_ch)
@@ -191,7 +211,7 @@ class EventProcessor:
                     self.log('No saved deconvolution results found, processing...', 2)
                     signal_t, signal, adc_step = event.signal_in_channel(i_ch, window=self.N)
                     rireff = self.ham_rireff if i_ch == 0 else self.feu84_rireff
-                    sample = self._process_signal_with_rireff(signal, adc_step, rireff)
+                    sample = self._process_signal_with_rireff(signal, adc_step, rireff, n_vec_estimations.get(i_ch))
 
                     np.savez(deconvolution_result_path, signal_t=signal_t, sample=sample)
                     self.log(f'Channel #{i_ch} deconvolution results saved', 2)
@@ -255,21 +275,78 @@ class EventProcessor:
 
     # DECONVOLUTION #
 
+    LAPLACE_SAMPLE_SIZE = 1000
+
     def _deconvolution_result_path(self, event_id: int, i_ch: int) -> Path:
         event_dir = self.DECONV_RESULTS_DIR / str(event_id)
         event_dir.mkdir(exist_ok=True)
         return event_dir / f"{i_ch}.deconv.npz"
 
+    def _estimate_n_vecs(self, event: Event, channels: Sequence[int]) -> Dict[int, NDArray[(Any,), float]]:
+        """Non-negative least squares n_vec estimations for given channels of the event, one batch per RIR; invalid
+        channels are skipped"""
+        n_vec_estimations = {}
+        for rireff, rireff_channels in (
+            (self.ham_rireff, [i_ch for i_ch in channels if i_ch == 0]),
+            (self.feu84_rireff, [i_ch for i_ch in channels if i_ch != 0]),
+        ):
+            valid_channels = []
+            signals = []
+            adc_steps = []
+            for i_ch in rireff_channels:
+                try:
+                    _, signal, adc_step = event.signal_in_channel(i_ch, window=self.N)
+                except ValueError:
+                    continue
+                valid_channels.append(i_ch)
+                signals.append(signal)
+                adc_steps.append(adc_step)
+            if valid_channels:
+                n_mat = rireff.estimate_n_mat(np.array(signals), delta=np.array(adc_steps))
+                n_vec_estimations.update(zip(valid_channels, n_mat))
+        return n_vec_estimations
+
     def _process_signal_with_rireff(
-        self, signal: Signal, adc_step: float, rireff: RandomizedIr
+        self,
+        signal: Signal,
+        adc_step: float,
+        rireff: RandomizedIr,
+        n_vec_estimation: Optional[NDArray[(Any,), float]] = None,
     ) -> NDArray[(Any, Any), float]:
-        n_vec_estimation = rireff.estimate_n_vec(signal, delta=adc_step)
+        if n_vec_estimation is None:
+            n_vec_estimation = rireff.estimate_n_mat(signal, delta=adc_step)[0]
+
+        if self.deconvolution_mode == 'laplace':
+            laplace = rireff.get_laplace_approximation(
+                signal, delta=adc_step, density=False, init_point=n_vec_estimation
+            )
+            self.log(f'Posterior mode found, loglike = {laplace.loglike_at_mode}', 2)
+            return laplace.sample(self.LAPLACE_SAMPLE_SIZE)
+
+        if self.sampling_backend == 'nuts':
+            # gradient-based sampler mixes well enough to skip preliminary run and tau estimation
+            result = mcmc.run_mcmc(
+                logposterior=rireff.get_loglikelihood_mvn_banded_value_and_grad(signal, delta=adc_step, density=False),
+                init_point=n_vec_estimation,
+                config=mcmc.SamplingConfig(
+                    backend='nuts',
+                    n_walkers=4,
+                    n_samples=1000,
+                    n_warmup=500,
+                    lower_bound=0.0,
+                    progress_bar=(self.verbosity > 1),
+                ),
+            )
+            return mcmc.extract_independent_sample(result.sampler, debug=(self.verbosity > 2))
 
         result_preliminary = mcmc.run_mcmc(
-            logposterior=rireff.get_loglikelihood_independent_normdist(signal, delta=adc_step, density=False),
+            logposterior=rireff.get_loglikelihood_independent_normdist_batch(signal, delta=adc_step, density=False),
             init_point=n_vec_estimation,
             config=mcmc.SamplingConfig(
-                n_walkers=256, n_samples=self.preliminary_run_length, progress_bar=(self.verbosity > 1)
+                n_walkers=256,
+                n_samples=self.preliminary_run_length,
+                progress_bar=(self.verbosity > 1),
+                vectorize=True,
             ),
         )
         taus = result_preliminary.sampler.get_autocorr_time(tol=0, quiet=True)
@@ -281,7 +358,7 @@ class EventProcessor:
             result_preliminary.sampler, tau_override=tau, desired_sample_size=n_walkers_final
         )
         result = mcmc.run_mcmc(
-            logposterior=rireff.get_loglikelihood_mvn(signal, delta=adc_step, density=False),
+            logposterior=rireff.get_loglikelihood_mvn_banded(signal, delta=adc_step, density=False),
             init_point=init_pts,
             config=mcmc.SamplingConfig(
                 n_walkers=n_walkers_final,
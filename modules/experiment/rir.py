@@ -3,6 +3,8 @@ Experimental Randomized IR reading and preprocessing
 """
 
 
+from __future__ import annotations
+
 import numpy as np
 import numdifftools as nd
 from scipy.interpolate import interp1d
@@ -81,6 +83,12 @@ def generate_C_pmt(n: int = 1) -> FloatVector:
     return Cpmt_invcdf_func(rng.uniform(size=n))
 
 
+def C_pmt_moments(max_order: int = 4, n_quadrature_pts: int = 10 ** 5) -> Tuple[float, ...]:
+    """Raw moments E[C_pmt^k], k = 1, ..., max_order, by midpoint rule over inverse CDF"""
+    Cpmt_quantiles = Cpmt_invcdf_func((np.arange(n_quadrature_pts) + 0.5) / n_quadrature_pts)
+    return tuple(np.mean(Cpmt_quantiles ** k) for k in range(1, max_order + 1))
+
+
 # for Hamamatsu Hamamatsu R3886, see Fig. 9 in
 # Antonov, R. A., Bonvech, E. A., Chernov, D. V., Podgrudkov, D. A., & Roganova, T. M. (2016).
 # The LED calibration system of the SPHERE-2 detector. Astroparticle Physics, 77, 55–65.
@@ -97,22 +105,40 @@ def generate_Ham_C_pmt(n: int) -> FloatVector:
     return (Ham_Cpmt_rv.rvs(size=n) - truncnorm_a) / (Ham_Cpmt_rv_mean - truncnorm_a)
 
 
+def Ham_C_pmt_moments(max_order: int = 4) -> Tuple[float, ...]:
+    """Raw moments E[C_pmt^k], k = 1, ..., max_order, of generate_Ham_C_pmt distribution"""
+    return tuple(
+        Ham_Cpmt_rv.expect(lambda x: ((x - truncnorm_a) / (Ham_Cpmt_rv_mean - truncnorm_a)) ** k)
+        for k in range(1, max_order + 1)
+    )
+
+
 # Convinience function to create RandomizedIrEffects from real IR data
 
-def get_rireffs(N: int) -> Tuple[RandomizedIrEffect, RandomizedIrEffect]:
+def get_rireffs(
+    N: int, samplesize: Optional[int] = None, cache_dir: Optional[Path] = None
+) -> Tuple[RandomizedIrEffect, RandomizedIrEffect]:
     """
     Return RandomizedIrEffects for Hamamatsu and ФЭУ 84/3
+
+    If samplesize is None (default), effects are calculated semi-analytically from C_pmt moments (fast and exact),
+    otherwise they are estimated from a sample of a given size (needed for ir_samples-based methods, e.g. MC likelihood)
+    and, if cache_dir is given, stored there and reused on subsequent calls.
     """
     ir_t, ir_shape = read_ir_shape()
     ir_t, ir_shape = cut_ir_shape(ir_t, ir_shape, excluded_integral_percentile=0.02)  # fine-tuned for reasonable length
 
-    samplesize = 10 ** 6
-
     rir = RandomizedIr(ir_x=ir_t, ir_y=ir_shape, factor=generate_C_pmt)
-    rireff = RandomizedIrEffect(rir, N, samplesize=samplesize)
-
     ham_rir = RandomizedIr(ir_x=ir_t, ir_y=ir_shape, factor=generate_Ham_C_pmt)
-    ham_rireff = RandomizedIrEffect(ham_rir, N, samplesize=samplesize)
+    if samplesize is None:
+        rireff = RandomizedIrEffect.from_factor_moments(rir, N, factor_moments=C_pmt_moments())
+        ham_rireff = RandomizedIrEffect.from_factor_moments(ham_rir, N, factor_moments=Ham_C_pmt_moments())
+    elif cache_dir is not None:
+        rireff = RandomizedIrEffect.cached(cache_dir, rir, N, samplesize=samplesize)
+        ham_rireff = RandomizedIrEffect.cached(cache_dir, ham_rir, N, samplesize=samplesize)
+    else:
+        rireff = RandomizedIrEffect(rir, N, samplesize=samplesize)
+        ham_rireff = RandomizedIrEffect(ham_rir, N, samplesize=samplesize)
     return ham_rireff, rireff
 
 
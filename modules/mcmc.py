@@ -2,6 +2,8 @@
 mcmc: wrapper around emcee module creating repeatable MCMC sampling routine
 """
 
+from __future__ import annotations
+
 import numpy as np
 import emcee
 from multiprocessing import Pool
@@ -14,6 +16,7 @@ from emcee.moves import Move
 from emcee.ensemble import EnsembleSampler
 
 from modules.utils import generate_poissonian_ns
+from modules.nuts import NutsSampler
 
 
 rng = np.random.default_rng()
@@ -32,11 +35,23 @@ class SamplingConfig:
     autocorr_estimation_each: Optional[int] = None  # None to avoid estimation
     debug_acceptance_fraction_each: Optional[int] = None  # None to not debug
     progress_bar: bool = False
+    # new fields go below to keep positional construction valid
+    # if True, logposterior takes (n_walkers, N) matrix of all walkers' positions and returns n_walkers values
+    vectorize: bool = False
+    # 'emcee' for affine-invariant ensemble sampler or 'nuts' for No-U-Turn Sampler, see modules.nuts;
+    # with 'nuts' logposterior must return (value, gradient) tuple and walkers are independent chains
+    backend: str = 'emcee'
+    # 'nuts' backend only: warm-up length, target acceptance statistic, max number of trajectory doublings and
+    # lower bound at which trajectories are reflected (e.g. 0 for n_vec)
+    n_warmup: int = 1000
+    target_accept: float = 0.8
+    max_tree_depth: int = 10
+    lower_bound: Optional[float] = None
 
 
 @dataclass
 class SamplingResult:
-    sampler: EnsembleSampler
+    sampler: Union[EnsembleSampler, NutsSampler]
     sample: Optional[NDArray] = None
     N_tau: Optional[Tuple[NDArray, NDArray]] = None
 
@@ -49,7 +64,8 @@ def run_mcmc(
     """High-level routine to sample posterior probability, automatically estimating burn-in and thinning
 
     Args:
-        logposterior (Callable[[NDArray[(Any,), float]], float]): function to draw sample from
+        logposterior (Callable[[NDArray[(Any,), float]], float]): function to draw sample from; with 'nuts' backend
+            it must return tuple of log-probability and its gradient
         init_point (NDArray[(Any,), float]): initial guess for n_vec (= model params) OR ini
         L (int): rir.L
         config (SamplingConfig): see SamplingConfig class for params
@@ -67,16 +83,33 @@ def run_mcmc(
             init_point, n_walkers=config.n_walkers, strategy=config.starting_points_strategy
         )
 
+    if config.backend not in {'emcee', 'nuts'}:
+        raise ValueError(f"Unknown sampling backend '{config.backend}'")
+    if config.backend == 'nuts' and (config.multiprocessing or config.vectorize):
+        raise ValueError("Multiprocessing and vectorization are only supported with 'emcee' backend")
+
     pool = Pool() if config.multiprocessing else None
 
     try:
-        sampler = emcee.EnsembleSampler(
-            config.n_walkers,
-            N,
-            logposterior,
-            moves=config.moves,
-            pool=pool,
-        )
+        if config.backend == 'emcee':
+            sampler = emcee.EnsembleSampler(
+                config.n_walkers,
+                N,
+                logposterior,
+                moves=config.moves,
+                pool=pool,
+                vectorize=config.vectorize,
+            )
+        else:
+            sampler = NutsSampler(
+                config.n_walkers,
+                N,
+                logposterior,
+                n_warmup=config.n_warmup,
+                target_accept=config.target_accept,
+                max_tree_depth=config.max_tree_depth,
+                lower_bound=config.lower_bound,
+            )
 
         # roughly estimates target sampling error of each parameter (n in bin)
         # see for details: https://emcee.readthedocs.io/en/stable/tutorials/autocorr/#autocorr
@@ -141,7 +174,7 @@ def starting_points_from_estimation(
 
 
 def extract_independent_sample(
-    sampler: EnsembleSampler,
+    sampler: Union[EnsembleSampler, NutsSampler],
     desired_sample_size: Optional[int] = None,
     tau_override: Optional[float] = None,
     debug: bool = False,
@@ -153,7 +186,7 @@ def extract_independent_sample(
         tau = np.tile(np.array([tau_override]), (sampler.nwalkers,))
 
     burnin = int(2 * np.max(tau))
-    thin = int(0.9 * np.min(tau))
+    thin = max(int(0.9 * np.min(tau)), 1)  # NUTS chains may be anticorrelated with tau < 1
 
     if debug:
         print(f'Autocorrelation time is estimated at {np.mean(tau)} (ranges from {np.min(tau)} to {np.max(tau)})')
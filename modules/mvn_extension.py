@@ -2,14 +2,21 @@
 mvn_extension: custom extension to scipy.stats.multivariate_normal
 """
 
+from __future__ import annotations
+
 import numpy as np
 from numpy.random import default_rng
 from scipy.stats import mvn
+from scipy.linalg import solve_triangular
+
+from functools import lru_cache
 
 from nptyping import NDArray
 from typing import Any
 from scipy.stats._multivariate import multivariate_normal_frozen
 
+from modules import banded_mvn
+
 
 rng: np.random.Generator = default_rng()
 
@@ -46,3 +53,75 @@ def integrate_pdf_fast(
     for i, qp in enumerate(rng.uniform(low=min_, high=min_ + delta, size=(n_pts, rv.dim))):
         pdf_vals[i] = rv.pdf(qp)
     return np.mean(pdf_vals) * (delta ** rv.dim)
+
+
+@lru_cache(maxsize=32)
+def kronecker_points(n_pts: int, dim: int) -> NDArray[(Any, Any), float]:
+    """First n_pts points of dim-dimensional Kronecker (R_d, generalized golden ratio) low-discrepancy sequence in unit
+    cube. Unlike Halton and unscrambled Sobol sequences it doesn't degrade with few points in high dimensions.
+
+    See http://extremelearning.com.au/unreasonable-effectiveness-of-quasirandom-sequences/
+    """
+    # phi_d is the only positive root of x^(d+1) = x + 1
+    phi_d = 2.0
+    for _ in range(100):
+        phi_d = (1 + phi_d) ** (1 / (dim + 1))
+    alpha = np.power(1 / phi_d, np.arange(1, dim + 1))
+    return (0.5 + np.outer(np.arange(1, n_pts + 1), alpha)) % 1
+
+
+def integrate_pdf_qmc(
+    rv: multivariate_normal_frozen,
+    min_: NDArray[(Any,), float],
+    delta: float,
+    n_pts: int = 512,
+    debug: bool = False,
+) -> float:
+    """Quasi-Monte-Carlo equivalent of integrate_pdf_fast: covariance is factorized once, PDF is evaluated at all
+    low-discrepancy points inside the box in one vectorized call, bypassing frozen distribution's per-call validation"""
+    try:
+        cov_chol = np.linalg.cholesky(rv.cov)
+    except np.linalg.LinAlgError:
+        if debug:
+            print('covariance matrix is not positive definite, probability integral is set to 0')
+        return 0.0
+    qps = min_ + delta * kronecker_points(n_pts, rv.dim)
+    z = solve_triangular(cov_chol, (qps - rv.mean).T, lower=True, check_finite=False)
+    log_pdf_vals = -0.5 * np.sum(z ** 2, axis=0) - np.sum(np.log(np.diag(cov_chol))) - 0.5 * rv.dim * np.log(2 * np.pi)
+    return np.mean(np.exp(log_pdf_vals)) * (delta ** rv.dim)
+
+
+def integrate_pdf_ghk(
+    rv: multivariate_normal_frozen,
+    min_: NDArray[(Any,), float],
+    delta: float,
+    n_pts: int = 256,
+    debug: bool = False,
+) -> float:
+    """Compiled GHK (sequential conditioning) box integration, see banded_mvn.ghk_log_box_probability. Dense covariance
+    is treated as a band matrix of full bandwidth. Low-discrepancy stream is fixed, so the result is deterministic."""
+    try:
+        cov_chol = np.linalg.cholesky(rv.cov)
+    except np.linalg.LinAlgError:
+        if debug:
+            print('covariance matrix is not positive definite, probability integral is set to 0')
+        return 0.0
+    log_integral = banded_mvn.ghk_log_box_probability_factorized(
+        min_, min_ + delta, rv.mean, banded_mvn.to_band(cov_chol), kronecker_points(n_pts, rv.dim)
+    )
+    return np.exp(log_integral)
+
+
+def log_integrate_pdf_batch(
+    means: NDArray[(Any, Any), float],
+    covs: NDArray[(Any, Any, Any), float],
+    min_: NDArray[(Any,), float],
+    delta: float,
+    n_pts: int = 256,
+) -> NDArray[(Any,), float]:
+    """Log-probabilities of the same box [min_, min_ + delta] for a batch of distributions with stacked means (W, dim)
+    and covariances (W, dim, dim), computed in one compiled parallel GHK call. Non positive definite covariances give
+    -inf."""
+    return banded_mvn.ghk_log_box_probability_batch(
+        min_, min_ + delta, means, banded_mvn.to_band(covs), kronecker_points(n_pts, means.shape[1])
+    )
@@ -2,11 +2,13 @@
 ndepdf: efficient calculation of empirical n-dimensional PDF used for Monte-Carlo likelihood estimation
 """
 
+from __future__ import annotations
+
 import numpy as np
 
-from collections import defaultdict
+from numba import njit
 
-from typing import Union, Any
+from typing import Union, Any, Tuple, Optional
 from nptyping import NDArray
 
 
@@ -32,34 +34,95 @@ def ndepdf(
                                too high, all bins wil contain 1-2 points and ePDF estimation is useless.
     """
     N_dim, N_sample = sample.shape
-    point = np.broadcast_to(point, (N_dim,))
-    bins = np.broadcast_to(np.array(bins), (N_sample,))
+    point = np.broadcast_to(point, (N_dim,)).reshape(N_dim, 1)
 
+    index = EmpiricalDensityIndex(np.min(sample, axis=1), np.max(sample, axis=1), bins)
     # if the point lies outside distiribution's bounding n-dimensional rectangle, ePDF is 0
-    mins = np.min(sample, axis=1)
-    maxes = np.max(sample, axis=1)
-    if not np.all(np.logical_and(mins <= point, point <= maxes)):
+    if not index.covers(point)[0]:
         return 0
-    # creating binnings for each dimension
-    # using list because binnings along each dimension may have different size
-    binnings = []
-    cell_volume = 1.0
-    for min_in_dim, max_in_dim, bin_count_in_dim in zip(mins, maxes, bins):
-        binning, step = np.linspace(min_in_dim, max_in_dim, bin_count_in_dim + 1, retstep=True)
-        binnings.append(binning)
-        cell_volume *= step
-    # binning the sample and the point with numpy.digitize
-    sample_binned = np.zeros_like(sample, dtype=int)
-    point_binned = np.zeros_like(point, dtype=int)
-    for i_dim, (sample_i, point_i, binning) in enumerate(zip(sample, point, binnings)):
-        point_binned[i_dim] = np.digitize(point_i, binning)
-        sample_binned[i_dim, :] = np.digitize(sample_i, binning)
-    # creating histogram with sparse N_dim-dimensional array represented as dictionary of keys
-    ndhist = defaultdict(lambda: 0)
-    for sample_binned_i in sample_binned.T:
-        ndhist[tuple(sample_binned_i)] += 1
+    index.add(sample)
     if check_bin_count:
-        s = sorted(ndhist.values(), reverse=True)
+        index.check_bin_count()
+    return index.pdf(point)[0]
+
+
+class EmpiricalDensityIndex:
+    """Sparse n-dimensional histogram on a fixed uniform grid: sample is binned once and then empirical PDF is
+    queried at any number of points. Sample may be extended incrementally with add, e.g. until the cell of interest
+    contains enough points. Sample points outside of the grid are counted in the sample size, but not in any cell."""
+
+    def __init__(
+        self,
+        mins: NDArray[(N_dim,), float],
+        maxes: NDArray[(N_dim,), float],
+        bins: Union[NDArray[(N_dim,), int], int],
+    ):
+        """Create empty index
+
+        Args:
+            mins, maxes: NDArray[(N_dim,), float]: grid's bounding n-dimensional rectangle
+            bins: Union[NDArray[(N_dim,), int], int]: number of bins along each dimension or a single number
+                                                      to use along all of them
+        """
+        self.mins = np.asarray(mins, dtype=float)
+        self.maxes = np.asarray(maxes, dtype=float)
+        N_dim = self.mins.size
+        self.bins = np.broadcast_to(np.array(bins), (N_dim,)).astype(np.int64)
+        # creating binnings for each dimension, padded to the same size to be stored in 2D array
+        self.binnings = np.zeros((N_dim, np.max(self.bins) + 1))
+        self.cell_volume = 1.0
+        for i_dim, (min_in_dim, max_in_dim, bin_count_in_dim) in enumerate(zip(self.mins, self.maxes, self.bins)):
+            self.binnings[i_dim, : bin_count_in_dim + 1], step = np.linspace(
+                min_in_dim, max_in_dim, bin_count_in_dim + 1, retstep=True
+            )
+            self.cell_volume *= step
+        self.key_groups = cell_key_groups(self.bins)
+        # histogram as lexicographically sorted array of occupied cells' keys and their counts
+        self.occupied_keys = np.zeros((0, self.key_groups[-1] + 1), dtype=np.int64)
+        self.counts = np.zeros((0,), dtype=int)
+        self.sample_size = 0
+
+    @classmethod
+    def from_sample(
+        cls, sample: NDArray[(N_dim, N_sample), float], bins: Union[NDArray[(N_dim,), int], int]
+    ) -> 'EmpiricalDensityIndex':
+        """Index with grid spanning sample's bounding n-dimensional rectangle, populated with the sample"""
+        index = cls(np.min(sample, axis=1), np.max(sample, axis=1), bins)
+        index.add(sample)
+        return index
+
+    @property
+    def dim(self) -> int:
+        return self.mins.size
+
+    def add(self, sample_chunk: NDArray[(N_dim, N_sample), float]):
+        chunk_keys, chunk_counts = unique_rows_with_counts(self._cell_keys(sample_chunk))
+        if self.sample_size == 0:
+            self.occupied_keys, self.counts = chunk_keys, chunk_counts
+        else:
+            self.occupied_keys, self.counts = unique_rows_with_counts(
+                np.concatenate((self.occupied_keys, chunk_keys)), np.concatenate((self.counts, chunk_counts))
+            )
+        self.sample_size += sample_chunk.shape[1]
+
+    def covers(self, points: NDArray[(N_dim, Any), float]) -> NDArray[(Any,), bool]:
+        """Check if points lie within grid's bounding n-dimensional rectangle"""
+        return np.all(np.logical_and(self.mins[:, np.newaxis] <= points, points <= self.maxes[:, np.newaxis]), axis=0)
+
+    def cell_counts(self, points: NDArray[(N_dim, Any), float]) -> NDArray[(Any,), int]:
+        """Number of sample points in the cells containing given points, 0 for points outside of the grid"""
+        counts = lookup_counts(self.occupied_keys, self.counts, self._cell_keys(points))
+        return np.where(self.covers(points), counts, 0)
+
+    def pdf(self, points: NDArray[(N_dim, Any), float]) -> NDArray[(Any,), float]:
+        """Empirical PDF at given points as a number of points from sample in the same cell relative to the sample
+        size and cell volume"""
+        return self.cell_counts(points) / (self.sample_size * self.cell_volume)
+
+    def check_bin_count(self):
+        """Check if bin count was set low enough: if it's too high, all bins contain 1-2 points and ePDF estimation is
+        useless."""
+        s = np.sort(self.counts)[::-1]
         max_points_per_bin = s[0]
         if max_points_per_bin < 10:
             raise ValueError(
@@ -67,13 +130,119 @@ def ndepdf(
                 + "Try lowering bins parameter"
             )
         else:
-            median_among_nonzero = np.median(np.array(s))
+            median_among_nonzero = np.median(s)
             print(
                 f"There's {max_points_per_bin} points per bin -- seems enough; "
                 + f"median is {median_among_nonzero} among nonzero bins"
             )
-    # finally, estimate PDF as a number of points from sample in the same bin relative to the sample size
-    return ndhist[tuple(point_binned)] / (N_sample * cell_volume)
+
+    def _cell_keys(self, points: NDArray[(N_dim, Any), float]) -> NDArray[(Any, Any), np.int64]:
+        return cell_keys(np.ascontiguousarray(points, dtype=float), self.binnings, self.bins, self.key_groups)
+
+
+def cell_key_groups(bins: NDArray[(N_dim,), int]) -> NDArray[(Any,), int]:
+    """Split dimensions into consecutive groups whose multi-indices can be raveled into a single int64 key.
+    Bin index along each dimension ranges from 0 to bins + 1 (see np.digitize), so radix is bins + 2.
+
+    Returns:
+        NDArray[(N_dim,), int]: index of group for each dimension
+    """
+    key_groups = np.zeros(len(bins), dtype=np.int64)
+    group = 0
+    group_size = 1
+    for i_dim, bin_count_in_dim in enumerate(bins):
+        radix = int(bin_count_in_dim) + 2
+        if group_size * radix > np.iinfo(np.int64).max:
+            group += 1
+            group_size = 1
+        group_size *= radix
+        key_groups[i_dim] = group
+    return key_groups
+
+
+@njit(cache=True)
+def cell_keys(
+    sample: NDArray[(N_dim, N_sample), float],
+    binnings: NDArray[(N_dim, Any), float],
+    bins: NDArray[(N_dim,), int],
+    key_groups: NDArray[(N_dim,), int],
+) -> NDArray[(N_sample, Any), np.int64]:
+    """Bin sample along each dimension exactly as np.digitize would and ravel multi-indices of the cells within each
+    group of dimensions (see cell_key_groups), so that each sample point's cell is identified by a row of int64 keys"""
+    N_dim, N_sample = sample.shape
+    keys = np.zeros((N_sample, key_groups[-1] + 1), dtype=np.int64)
+    for i_dim in range(N_dim):
+        n_edges = bins[i_dim] + 1
+        binning = binnings[i_dim, :n_edges]
+        span = binning[-1] - binning[0]
+        index_per_unit = bins[i_dim] / span if span > 0 else 0.0
+        radix = bins[i_dim] + 2
+        group = key_groups[i_dim]
+        for i_sample in range(N_sample):
+            x = sample[i_dim, i_sample]
+            # uniform binning allows to guess the bin, then guess is corrected against actual edges
+            guess = (x - binning[0]) * index_per_unit + 1
+            i_bin = int(min(max(guess, 0), n_edges))
+            while i_bin > 0 and x < binning[i_bin - 1]:
+                i_bin -= 1
+            while i_bin < n_edges and x >= binning[i_bin]:
+                i_bin += 1
+            keys[i_sample, group] = keys[i_sample, group] * radix + i_bin
+    return keys
+
+
+def unique_rows_with_counts(
+    keys: NDArray[(N_sample, Any), np.int64], weights: Optional[NDArray[(N_sample,), int]] = None
+) -> Tuple[NDArray[(Any, Any), np.int64], NDArray[(Any,), int]]:
+    """Unique rows of keys in lexicographical order and number of their occurences (or sum of their weights)"""
+    if weights is None:
+        weights = np.ones(keys.shape[0], dtype=int)
+    if keys.shape[1] == 1:
+        flat_keys = keys[:, 0]
+        if flat_keys.size and flat_keys.max() < 4 * flat_keys.size:
+            # few enough cells to count all of them directly
+            all_counts = np.bincount(flat_keys, weights=weights).astype(int)
+            occupied_keys = np.flatnonzero(all_counts)
+            return occupied_keys.reshape(-1, 1), all_counts[occupied_keys]
+        order = np.argsort(flat_keys)
+    else:
+        order = np.lexsort(keys.T[::-1])
+    keys_sorted = keys[order]
+    is_new_row = np.ones(keys_sorted.shape[0], dtype=bool)
+    is_new_row[1:] = np.any(keys_sorted[1:] != keys_sorted[:-1], axis=1)
+    first_occurences = np.flatnonzero(is_new_row)
+    if first_occurences.size == 0:
+        return keys_sorted, np.zeros((0,), dtype=int)
+    return keys_sorted[first_occurences], np.add.reduceat(weights[order], first_occurences)
+
+
+@njit(cache=True)
+def lookup_counts(
+    occupied_keys: NDArray[(Any, Any), np.int64],
+    counts: NDArray[(Any,), int],
+    query_keys: NDArray[(Any, Any), np.int64],
+) -> NDArray[(Any,), int]:
+    """Binary search of query keys' rows among lexicographically sorted unique occupied keys, 0 if not found"""
+    n_occupied, n_groups = occupied_keys.shape
+    query_counts = np.zeros(query_keys.shape[0], dtype=counts.dtype)
+    for i_query in range(query_keys.shape[0]):
+        lo = 0
+        hi = n_occupied
+        while lo < hi:
+            mid = (lo + hi) // 2
+            comparison = 0
+            for group in range(n_groups):
+                if occupied_keys[mid, group] != query_keys[i_query, group]:
+                    comparison = 1 if occupied_keys[mid, group] < query_keys[i_query, group] else -1
+                    break
+            if comparison == 0:
+                query_counts[i_query] = counts[mid]
+                break
+            elif comparison > 0:
+                lo = mid + 1
+            else:
+                hi = mid
+    return query_counts
 
 
 if __name__ == "__main__":
@@ -96,11 +265,16 @@ if __name__ == "__main__":
     xmeans = 0.5 * (xedges[1:] + xedges[:-1])
     ymeans = 0.5 * (yedges[1:] + yedges[:-1])
 
+    # sample is binned once and queried at all cell centers
+    index = EmpiricalDensityIndex.from_sample(sample, bins=N_bins)
+    points = np.array([[x, y] for x, y in product(xmeans, ymeans)]).T
+    pdf_values = index.pdf(points).reshape(xmeans.size, ymeans.size)
+
     residual_sqsum = 0
     for (i, x), (j, y) in product(enumerate(xmeans), enumerate(ymeans)):
         if counts[i, j] < 0.1:
             continue
-        residual = ndepdf(sample, np.array([x, y]), bins=N_bins) - counts[i, j]
+        residual = pdf_values[i, j] - counts[i, j]
         residual_sqsum += residual ** 2
         # if abs(residual) > abs(max_residual):
         #     max_residual = residual
@@ -0,0 +1,373 @@
+"""
+nuts: compact No-U-Turn Sampler with step size and diagonal mass matrix adaptation
+
+NutsSampler runs several independent chains and mimics the part of emcee.EnsembleSampler interface used by mcmc
+module (sample, get_chain, get_autocorr_time, nwalkers, iteration, acceptance_fraction), chains playing the role
+of walkers. See Hoffman & Gelman (2014), "The No-U-Turn Sampler", algorithms 3 and 6.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+from dataclasses import dataclass
+from emcee.autocorr import integrated_time
+from tqdm import tqdm
+
+from typing import Any, Callable, Tuple, Iterator, Optional, List
+from nptyping import NDArray
+
+
+ValueAndGrad = Callable[[NDArray[(Any,), float]], Tuple[float, NDArray[(Any,), float]]]
+
+
+@dataclass
+class _Tree:
+    """Subtree built by NUTS doubling: its leftmost and rightmost states, proposal and acceptance statistics"""
+
+    theta_minus: NDArray
+    r_minus: NDArray
+    grad_minus: NDArray
+    theta_plus: NDArray
+    r_plus: NDArray
+    grad_plus: NDArray
+    theta_proposal: NDArray
+    logp_proposal: float
+    grad_proposal: NDArray
+    n_valid: int
+    keep_going: bool
+    sum_alpha: float
+    n_alpha: int
+    diverged: bool
+
+
+class NutsSampler:
+    # dual averaging parameters, see Hoffman & Gelman (2014), section 3.2.1
+    DUAL_AVERAGING_GAMMA = 0.05
+    DUAL_AVERAGING_T0 = 10
+    DUAL_AVERAGING_KAPPA = 0.75
+    # energy error treated as divergence of the trajectory
+    MAX_ENERGY_ERROR = 1000.0
+    # Stan-like warm-up schedule: step size only, then mass matrix windows doubling in size, then step size only
+    WARMUP_INIT_BUFFER = 75
+    WARMUP_TERM_BUFFER = 50
+    WARMUP_BASE_WINDOW = 25
+
+    def __init__(
+        self,
+        nwalkers: int,
+        ndim: int,
+        value_and_grad: ValueAndGrad,
+        n_warmup: int = 1000,
+        target_accept: float = 0.8,
+        max_tree_depth: int = 10,
+        lower_bound: Optional[float] = None,
+        seed: Optional[int] = None,
+    ):
+        """
+        Args:
+            nwalkers (int): number of independent chains
+            ndim (int): dimensionality of parameter space
+            value_and_grad (ValueAndGrad): function returning log-probability and its gradient at a given point;
+                -inf log-probability is allowed and treated as divergence of the trajectory
+            n_warmup (int, optional): number of adaptation steps done before recording the chains. Defaults to 1000.
+            target_accept (float, optional): target mean acceptance statistic for step size tuning. Defaults to 0.8.
+            max_tree_depth (int, optional): maximum number of trajectory doublings. Defaults to 10.
+            lower_bound (Optional[float], optional): if set, trajectories are reflected at this value in all
+                dimensions (position mirrored, momentum flipped), which keeps leapfrog integrator reversible and
+                volume-preserving, so that densities truncated there (e.g. n >= 0) are sampled without divergences
+                at the boundary. Defaults to None.
+            seed (Optional[int], optional): seed for sampler's random generator. Defaults to None.
+        """
+        if not 0 < target_accept < 1:
+            raise ValueError(f"target_accept must be in (0, 1), but {target_accept} is passed")
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.value_and_grad = value_and_grad
+        self.n_warmup = n_warmup
+        self.target_accept = target_accept
+        self.max_tree_depth = max_tree_depth
+        self.lower_bound = lower_bound
+        self.rng = np.random.default_rng(seed)
+
+        self.inv_metric = np.ones(ndim)  # diagonal of inverse mass matrix, i.e. estimated posterior variances
+        self.step_size = np.ones(nwalkers)
+        self.is_warmed_up = False
+
+        self.iteration = 0
+        self._chain: List[NDArray[(Any, Any), float]] = []
+        self._sum_accept_stat = np.zeros(nwalkers)
+        self.n_divergent = np.zeros(nwalkers, dtype=int)
+        self.tree_depths: List[NDArray[(Any,), int]] = []
+
+    # emcee.EnsembleSampler-like interface
+
+    @property
+    def acceptance_fraction(self) -> NDArray[(Any,), float]:
+        """Mean NUTS acceptance statistic for each chain"""
+        return self._sum_accept_stat / max(self.iteration, 1)
+
+    def get_chain(self, flat: bool = False, thin: int = 1, discard: int = 0) -> NDArray:
+        """Recorded chains as (iteration, nwalkers, ndim) array, or (iteration * nwalkers, ndim) if flat"""
+        chain = np.array(self._chain).reshape((self.iteration, self.nwalkers, self.ndim))[discard::thin]
+        if flat:
+            chain = chain.reshape((-1, self.ndim))
+        return chain
+
+    def get_autocorr_time(self, discard: int = 0, thin: int = 1, **kwargs) -> NDArray[(Any,), float]:
+        """Integrated autocorrelation time for each parameter, see emcee.autocorr.integrated_time for kwargs"""
+        return thin * integrated_time(self.get_chain(discard=discard, thin=thin), **kwargs)
+
+    def sample(
+        self, initial_state: NDArray[(Any, Any), float], iterations: int = 1, progress: bool = False
+    ) -> Iterator[NDArray[(Any, Any), float]]:
+        """Generator running all chains in lockstep and yielding their current positions after each recorded
+        iteration. Warm-up is done on the first call and is not recorded."""
+        theta = np.array(initial_state, dtype=float).reshape((self.nwalkers, self.ndim))
+        logp = np.empty(self.nwalkers)
+        grad = np.empty((self.nwalkers, self.ndim))
+        for i_chain in range(self.nwalkers):
+            logp[i_chain], grad[i_chain] = self.value_and_grad(theta[i_chain])
+        if not np.all(np.isfinite(logp)):
+            raise ValueError("Log-probability must be finite at starting points of all chains")
+
+        pbar = tqdm(total=(0 if self.is_warmed_up else self.n_warmup) + iterations) if progress else None
+        if not self.is_warmed_up:
+            self._warmup(theta, logp, grad, pbar)
+        for _ in range(iterations):
+            depths = np.empty(self.nwalkers, dtype=int)
+            for i_chain in range(self.nwalkers):
+                theta[i_chain], logp[i_chain], grad[i_chain], accept_stat, diverged, depths[i_chain] = self._transition(
+                    theta[i_chain], logp[i_chain], grad[i_chain], self.step_size[i_chain]
+                )
+                self._sum_accept_stat[i_chain] += accept_stat
+                self.n_divergent[i_chain] += diverged
+            self._chain.append(theta.copy())
+            self.tree_depths.append(depths)
+            self.iteration += 1
+            if pbar is not None:
+                pbar.update()
+            yield theta.copy()
+        if pbar is not None:
+            pbar.close()
+
+    # adaptation
+
+    def _warmup(self, theta: NDArray, logp: NDArray, grad: NDArray, pbar: Optional[tqdm]):
+        """Adapt step sizes and inverse mass matrix in place, moving chains to the typical set"""
+        window_ends = self._metric_window_ends()
+        window_draws = []
+        self._init_dual_averaging(theta, logp, grad)
+        for i_warmup in range(self.n_warmup):
+            for i_chain in range(self.nwalkers):
+                theta[i_chain], logp[i_chain], grad[i_chain], accept_stat, _, _ = self._transition(
+                    theta[i_chain], logp[i_chain], grad[i_chain], np.exp(self._log_step_size[i_chain])
+                )
+                self._update_dual_averaging(i_chain, accept_stat)
+            if window_ends and window_ends[0][0] <= i_warmup:
+                window_draws.append(theta.copy())
+                if i_warmup == window_ends[0][1] - 1:
+                    window_ends.pop(0)
+                    self._update_inv_metric(np.concatenate(window_draws, axis=0))
+                    window_draws = []
+                    self._init_dual_averaging(theta, logp, grad)
+            if pbar is not None:
+                pbar.update()
+        self.step_size = np.exp(self._log_step_size_bar)
+        self.is_warmed_up = True
+
+    def _metric_window_ends(self) -> List[Tuple[int, int]]:
+        """(start, end) warm-up iterations of windows used for mass matrix estimation"""
+        if self.n_warmup < 20:
+            return []
+        init_buffer = self.WARMUP_INIT_BUFFER
+        term_buffer = self.WARMUP_TERM_BUFFER
+        window_size = self.WARMUP_BASE_WINDOW
+        if init_buffer + window_size + term_buffer > self.n_warmup:
+            init_buffer = int(0.15 * self.n_warmup)
+            term_buffer = int(0.1 * self.n_warmup)
+            window_size = self.n_warmup - init_buffer - term_buffer
+        windows = []
+        start = init_buffer
+        adaptation_end = self.n_warmup - term_buffer
+        while start < adaptation_end:
+            end = start + window_size
+            # last window is stretched to the terminal buffer if the next one wouldn't fit
+            if end + 2 * window_size > adaptation_end:
+                end = adaptation_end
+            windows.append((start, end))
+            start = end
+            window_size *= 2
+        return windows
+
+    def _update_inv_metric(self, draws: NDArray[(Any, Any), float]):
+        """Regularized variance of warm-up draws pooled over chains, shrunk towards 1e-3, as in Stan"""
+        n = draws.shape[0]
+        self.inv_metric = (n / (n + 5.0)) * np.var(draws, axis=0) + 1e-3 * (5.0 / (n + 5.0))
+
+    def _init_dual_averaging(self, theta: NDArray, logp: NDArray, grad: NDArray):
+        self._log_step_size = np.array(
+            [
+                np.log(self._find_reasonable_step_size(theta[i_chain], logp[i_chain], grad[i_chain]))
+                for i_chain in range(self.nwalkers)
+            ]
+        )
+        self._dual_averaging_mu = np.log(10) + self._log_step_size
+        self._log_step_size_bar = np.zeros(self.nwalkers)
+        self._H_bar = np.zeros(self.nwalkers)
+        self._dual_averaging_counter = np.zeros(self.nwalkers)
+
+    def _update_dual_averaging(self, i_chain: int, accept_stat: float):
+        self._dual_averaging_counter[i_chain] += 1
+        m = self._dual_averaging_counter[i_chain]
+        w = 1 / (m + self.DUAL_AVERAGING_T0)
+        self._H_bar[i_chain] = (1 - w) * self._H_bar[i_chain] + w * (self.target_accept - accept_stat)
+        self._log_step_size[i_chain] = (
+            self._dual_averaging_mu[i_chain] - np.sqrt(m) / self.DUAL_AVERAGING_GAMMA * self._H_bar[i_chain]
+        )
+        eta = m ** (-self.DUAL_AVERAGING_KAPPA)
+        self._log_step_size_bar[i_chain] = (
+            eta * self._log_step_size[i_chain] + (1 - eta) * self._log_step_size_bar[i_chain]
+        )
+
+    def _find_reasonable_step_size(self, theta: NDArray, logp: float, grad: NDArray) -> float:
+        """Heuristic from Hoffman & Gelman (2014), algorithm 4: double or halve step size until acceptance
+        probability of a single leapfrog step crosses 0.5"""
+        step_size = 1.0
+        r = self._sample_momentum()
+        joint = logp - self._kinetic_energy(r)
+
+        def log_acceptance_ratio(step_size):
+            _, r_new, logp_new, _ = self._leapfrog(theta, r, grad, step_size)
+            log_ratio = logp_new - self._kinetic_energy(r_new) - joint
+            return log_ratio if np.isfinite(log_ratio) else -np.inf
+
+        log_ratio = log_acceptance_ratio(step_size)
+        direction = 1 if log_ratio > np.log(0.5) else -1
+        for _ in range(100):
+            if direction * log_ratio <= -direction * np.log(2):
+                break
+            step_size *= 2.0 ** direction
+            log_ratio = log_acceptance_ratio(step_size)
+        return step_size
+
+    # NUTS transition
+
+    def _sample_momentum(self) -> NDArray[(Any,), float]:
+        return self.rng.normal(size=self.ndim) / np.sqrt(self.inv_metric)
+
+    def _kinetic_energy(self, r: NDArray[(Any,), float]) -> float:
+        return 0.5 * np.sum(self.inv_metric * r ** 2)
+
+    def _leapfrog(
+        self, theta: NDArray, r: NDArray, grad: NDArray, step_size: float
+    ) -> Tuple[NDArray, NDArray, float, NDArray]:
+        r_new = r + 0.5 * step_size * grad
+        theta_new = theta + step_size * self.inv_metric * r_new
+        if self.lower_bound is not None:
+            is_reflected = theta_new < self.lower_bound
+            theta_new[is_reflected] = 2 * self.lower_bound - theta_new[is_reflected]
+            r_new[is_reflected] = -r_new[is_reflected]
+        logp_new, grad_new = self.value_and_grad(theta_new)
+        if not np.isfinite(logp_new):
+            return theta_new, r_new, -np.inf, np.zeros_like(grad)
+        r_new = r_new + 0.5 * step_size * grad_new
+        return theta_new, r_new, logp_new, grad_new
+
+    def _no_u_turn(self, theta_minus: NDArray, r_minus: NDArray, theta_plus: NDArray, r_plus: NDArray) -> bool:
+        delta_theta = theta_plus - theta_minus
+        return (
+            np.dot(delta_theta, self.inv_metric * r_minus) >= 0 and np.dot(delta_theta, self.inv_metric * r_plus) >= 0
+        )
+
+    def _transition(
+        self, theta: NDArray, logp: float, grad: NDArray, step_size: float
+    ) -> Tuple[NDArray, float, NDArray, float, bool, int]:
+        """One NUTS iteration; returns new position with its log-probability and gradient, acceptance statistic,
+        divergence flag and tree depth"""
+        r0 = self._sample_momentum()
+        joint0 = logp - self._kinetic_energy(r0)
+        log_u = joint0 - self.rng.exponential()  # log of slice variable
+
+        theta_minus, r_minus, grad_minus = theta, r0, grad
+        theta_plus, r_plus, grad_plus = theta, r0, grad
+        theta_new, logp_new, grad_new = theta, logp, grad
+        n_valid = 1
+        depth = 0
+        accept_stat = 0.0
+        diverged = False
+        keep_going = True
+        while keep_going and depth < self.max_tree_depth:
+            direction = 1 if self.rng.random() < 0.5 else -1
+            if direction == -1:
+                tree = self._build_tree(theta_minus, r_minus, grad_minus, log_u, direction, depth, step_size, joint0)
+                theta_minus, r_minus, grad_minus = tree.theta_minus, tree.r_minus, tree.grad_minus
+            else:
+                tree = self._build_tree(theta_plus, r_plus, grad_plus, log_u, direction, depth, step_size, joint0)
+                theta_plus, r_plus, grad_plus = tree.theta_plus, tree.r_plus, tree.grad_plus
+            if tree.keep_going and self.rng.random() < tree.n_valid / n_valid:
+                theta_new, logp_new, grad_new = tree.theta_proposal, tree.logp_proposal, tree.grad_proposal
+            n_valid += tree.n_valid
+            keep_going = tree.keep_going and self._no_u_turn(theta_minus, r_minus, theta_plus, r_plus)
+            accept_stat = tree.sum_alpha / tree.n_alpha
+            diverged = diverged or tree.diverged
+            depth += 1
+        return theta_new, logp_new, grad_new, accept_stat, diverged, depth
+
+    def _build_tree(
+        self,
+        theta: NDArray,
+        r: NDArray,
+        grad: NDArray,
+        log_u: float,
+        direction: int,
+        depth: int,
+        step_size: float,
+        joint0: float,
+    ) -> _Tree:
+        if depth == 0:
+            theta_new, r_new, logp_new, grad_new = self._leapfrog(theta, r, grad, direction * step_size)
+            joint = logp_new - self._kinetic_energy(r_new)
+            diverged = not (log_u - self.MAX_ENERGY_ERROR < joint)
+            return _Tree(
+                theta_minus=theta_new,
+                r_minus=r_new,
+                grad_minus=grad_new,
+                theta_plus=theta_new,
+                r_plus=r_new,
+                grad_plus=grad_new,
+                theta_proposal=theta_new,
+                logp_proposal=logp_new,
+                grad_proposal=grad_new,
+                n_valid=int(log_u <= joint),
+                keep_going=not diverged,
+                sum_alpha=min(1.0, np.exp(joint - joint0)) if np.isfinite(joint) else 0.0,
+                n_alpha=1,
+                diverged=diverged,
+            )
+
+        tree = self._build_tree(theta, r, grad, log_u, direction, depth - 1, step_size, joint0)
+        if not tree.keep_going:
+            return tree
+        if direction == -1:
+            subtree = self._build_tree(
+                tree.theta_minus, tree.r_minus, tree.grad_minus, log_u, direction, depth - 1, step_size, joint0
+            )
+            tree.theta_minus, tree.r_minus, tree.grad_minus = subtree.theta_minus, subtree.r_minus, subtree.grad_minus
+        else:
+            subtree = self._build_tree(
+                tree.theta_plus, tree.r_plus, tree.grad_plus, log_u, direction, depth - 1, step_size, joint0
+            )
+            tree.theta_plus, tree.r_plus, tree.grad_plus = subtree.theta_plus, subtree.r_plus, subtree.grad_plus
+        n_valid_total = tree.n_valid + subtree.n_valid
+        if n_valid_total > 0 and self.rng.random() < subtree.n_valid / n_valid_total:
+            tree.theta_proposal = subtree.theta_proposal
+            tree.logp_proposal = subtree.logp_proposal
+            tree.grad_proposal = subtree.grad_proposal
+        tree.n_valid = n_valid_total
+        tree.sum_alpha += subtree.sum_alpha
+        tree.n_alpha += subtree.n_alpha
+        tree.diverged = tree.diverged or subtree.diverged
+        tree.keep_going = subtree.keep_going and self._no_u_turn(
+            tree.theta_minus, tree.r_minus, tree.theta_plus, tree.r_plus
+        )
+        return tree
@@ -3,40 +3,222 @@ randomized_ir: classes for modelling randomized impulse response and using it fo
 """
 
 
+from __future__ import annotations
+
+import os
 import math
+import inspect
+import hashlib
 import numpy as np
 from matplotlib import pyplot as plt
 import numdifftools as nd
 
-from numba import njit
+from numba import njit, prange
 
 from scipy.interpolate import interp1d
+from scipy.optimize import minimize
+from scipy.signal import oaconvolve
 from numpy.linalg import pinv
 from math import pi, erf
 
+from scipy.stats import truncnorm
 from scipy.stats._multivariate import multivariate_normal_frozen
 
-from functools import partial, lru_cache
+from functools import partial, cached_property
+from dataclasses import dataclass
+from pathlib import Path
 
 from tqdm import tqdm_notebook
-from typing import Union, Callable, Optional, Any, Dict
+from typing import Union, Callable, Optional, Any, Dict, Sequence, Tuple
 from nptyping import NDArray
 
 import modules.utils as utils
-from modules.ndepdf import ndepdf
+from modules.ndepdf import ndepdf, EmpiricalDensityIndex
 from modules import mvn_extension
+from modules import banded_mvn
 
 
 rng = np.random.default_rng()
 
 
+@njit(cache=True)
+def lookup_ir_at(x: float, lookup_table: NDArray[(Any,), float], lookup_step: float, x_max: float) -> float:
+    """Linearly interpolated value of the IR tabulated on a uniform grid 0, lookup_step, 2 * lookup_step, ...
+    Zero outside of [0, x_max]. Callable from numba-compiled code."""
+    if x < 0 or x > x_max:
+        return 0.0
+    u = x / lookup_step
+    i = min(int(u), lookup_table.size - 2)
+    w = u - i
+    return (1 - w) * lookup_table[i] + w * lookup_table[i + 1]
+
+
+@njit(cache=True)
+def lookup_ir(x: NDArray[(Any,), float], lookup_table: NDArray[(Any,), float], lookup_step: float, x_max: float):
+    """Vectorized lookup_ir_at for 1D array of query points"""
+    y = np.empty_like(x)
+    for i in range(x.size):
+        y[i] = lookup_ir_at(x[i], lookup_table, lookup_step, x_max)
+    return y
+
+
+@njit(cache=True)
+def splitmix64(x: np.uint64) -> np.uint64:
+    """Bijective 64-bit integer mixer, see https://prng.di.unimi.it/splitmix64.c"""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+@njit(parallel=True, cache=True)
+def sample_S_vec_iid(
+    ir_pool: NDArray[(Any, Any), float], n_vec: NDArray[(Any,), int], start: int, out: NDArray[(Any, Any), float]
+):
+    """Signal realizations with IR realization of each photoelectron drawn independently from ir_pool (one per row).
+    Numba keeps separate random state for each thread, so realizations are generated in parallel.
+    See sample_S_vec_crn for description of arguments."""
+    n_samples, n_bins = out.shape
+    pool_size, ir_length = ir_pool.shape
+    for k in prange(n_samples):
+        out[k, :] = 0.0
+        for i in range(n_vec.size):
+            lag_from = max(0, start - i)
+            lag_to = min(ir_length, start + n_bins - i)
+            if lag_from >= lag_to:
+                continue
+            for _ in range(n_vec[i]):
+                ir_index = np.random.randint(0, pool_size)
+                for lag in range(lag_from, lag_to):
+                    out[k, i + lag - start] += ir_pool[ir_index, lag]
+
+
+@njit(parallel=True, cache=True)
+def sample_S_vec_crn(
+    ir_pool: NDArray[(Any, Any), float],
+    n_vec: NDArray[(Any,), int],
+    seed: int,
+    sample_offset: int,
+    start: int,
+    out: NDArray[(Any, Any), float],
+):
+    """Signal realizations with common random numbers: IR realization of p-th photoelectron in i-th bin of k-th sample
+    is taken from ir_pool at index given by hash(seed, k, i, p). Draws depend only on these counters, so samples for nearby n_vecs
+    share most of the draws, and photoelectrons not contributing to the requested signal bins may be skipped.
+
+    Args:
+        ir_pool (NDArray[(Any, L + 1), float]): pool of IR realizations, one per row
+        n_vec (NDArray[(N,), int]): photoelectron counts
+        seed (int): common random numbers stream id
+        sample_offset (int): global index k of the first sample, to extend the sample in chunks
+        start (int): index of the first signal bin to generate
+        out (NDArray[(n_samples, n_bins), float]): output buffer receiving signal bins start, ..., start + n_bins - 1
+    """
+    n_samples, n_bins = out.shape
+    pool_size = np.uint64(ir_pool.shape[0])
+    ir_length = ir_pool.shape[1]
+    bits_32 = np.uint64(32)
+    for k in prange(n_samples):
+        out[k, :] = 0.0
+        sample_hash = splitmix64(np.uint64(seed) ^ splitmix64(np.uint64(sample_offset + k)))
+        for i in range(n_vec.size):
+            lag_from = max(0, start - i)
+            lag_to = min(ir_length, start + n_bins - i)
+            if lag_from >= lag_to:
+                continue
+            bin_hash = splitmix64(sample_hash ^ np.uint64(i))
+            for p in range(n_vec[i]):
+                # mapping upper 32 bits of the hash to [0, pool_size) by multiplication instead of slow modulo
+                ir_index = ((splitmix64(bin_hash ^ np.uint64(p)) >> bits_32) * pool_size) >> bits_32
+                for lag in range(lag_from, lag_to):
+                    out[k, i + lag - start] += ir_pool[ir_index, lag]
+
+
+SQRT_2PI = np.sqrt(2 * pi)
+
+
+@njit(cache=True)
+def norm_cdf(z: float) -> float:
+    """Standard normal CDF"""
+    return 0.5 * (1 + erf(z / np.sqrt(2)))
+
+
+@njit(cache=True)
+def edgeworth_pdf(z: float, gamma_1: float, gamma_2: float) -> float:
+    """Edgeworth expansion of standardized PDF with skewness gamma_1 and excess kurtosis gamma_2 up to O(1/n)"""
+    He_3 = z ** 3 - 3 * z
+    He_4 = z ** 4 - 6 * z ** 2 + 3
+    He_6 = z ** 6 - 15 * z ** 4 + 45 * z ** 2 - 15
+    correction = 1 + gamma_1 / 6 * He_3 + gamma_2 / 24 * He_4 + gamma_1 ** 2 / 72 * He_6
+    return np.exp(-0.5 * z ** 2) / SQRT_2PI * correction
+
+
+@njit(cache=True)
+def edgeworth_cdf(z: float, gamma_1: float, gamma_2: float) -> float:
+    """Integral of edgeworth_pdf from -inf to z"""
+    He_2 = z ** 2 - 1
+    He_3 = z ** 3 - 3 * z
+    He_5 = z ** 5 - 10 * z ** 3 + 15 * z
+    correction = gamma_1 / 6 * He_2 + gamma_2 / 24 * He_3 + gamma_1 ** 2 / 72 * He_5
+    return norm_cdf(z) - np.exp(-0.5 * z ** 2) / SQRT_2PI * correction
+
+
+class InbinTimeDistribution:
+    def __init__(self, t: NDArray[(Any,), float], cdf: NDArray[(Any,), float]):
+        """Tabulated distribution of delta times inside one bin, sampled in bulk with inverse CDF table lookup.
+        Can be passed as `inbin_invcdf` anywhere in place of a scalar inverse CDF function.
+
+        Args:
+            t (NDArray): increasing in-bin times from 0 to 1
+            cdf (NDArray): non-decreasing CDF values at `t`, normalized automatically to go from 0 to 1
+        """
+        if t.ndim != 1 or t.shape != cdf.shape:
+            raise ValueError("t and cdf must be one-dimensional numpy arrays of the same size")
+        if t[0] != 0 or t[-1] != 1 or np.any(np.diff(t) <= 0):
+            raise ValueError("t must increase from 0 to 1")
+        if np.any(np.diff(cdf) < 0):
+            raise ValueError("cdf must be non-decreasing")
+        self.t = t
+        self.cdf = (cdf - cdf[0]) / (cdf[-1] - cdf[0])
+
+    @classmethod
+    def from_pdf(cls, t: NDArray[(Any,), float], pdf: NDArray[(Any,), float]) -> 'InbinTimeDistribution':
+        """Create from (not necessarily normalized) PDF values at `t`, integrated with trapezoidal rule"""
+        cdf = np.concatenate(([0.0], np.cumsum(0.5 * (pdf[1:] + pdf[:-1]) * np.diff(t))))
+        return cls(t, cdf)
+
+    def __call__(self, uniform_sample: NDArray) -> NDArray:
+        """Inverse CDF, vectorized"""
+        return np.interp(uniform_sample, self.cdf, self.t)
+
+    def sample(self, size) -> NDArray:
+        return self(rng.random(size=size))
+
+
+InbinTimes = Union[Callable[[float], float], InbinTimeDistribution]
+
+
+def sample_inbin_times(inbin_invcdf: Optional[InbinTimes], size) -> NDArray:
+    """Sample in-bin delta times of a given size. inbin_invcdf is None (uniform distribution), InbinTimeDistribution
+    (fast, vectorized) or any scalar inverse CDF function (slow fallback, called once per sample point)"""
+    uniform_sample = rng.random(size=size)
+    if inbin_invcdf is None:
+        return uniform_sample
+    elif isinstance(inbin_invcdf, InbinTimeDistribution):
+        return inbin_invcdf(uniform_sample)
+    else:
+        return np.vectorize(inbin_invcdf)(uniform_sample)
+
+
 class RandomizedIr:
     def __init__(
         self,
         ir_x: NDArray,
-        ir_y: Union[NDArray, Callable[[], NDArray]],
+        ir_y: Union[NDArray, Callable[..., NDArray]],
         factor: Optional[Callable[[int], NDArray]] = None,
         binsize: float = 1.0,
+        ir_y_batched: bool = False,
+        lookup_step: Optional[float] = None,
     ):
         """Create randomized impulse response
 
@@ -48,6 +230,13 @@ class RandomizedIr:
                                                   If None (default), no factor is applied.
             binsize (float, optional): If `ir_x` is in some units other than bins, specify this for conversion.
                                        Defaults to 1.0.
+            ir_y_batched (bool, optional): if True, callable `ir_y` must accept number of realizations n and return
+                                           them stacked as columns of (ir_x.size, n) array. Much faster for large
+                                           batches. Defaults to False.
+            lookup_step (float, optional): if given, frozen base IR is tabulated once on a uniform grid with this step
+                                           (in bins, e.g. 1e-3) and evaluated with O(1) index-and-lerp lookup
+                                           instead of interp1d. See lookup_ir_at for use in numba code.
+                                           Defaults to None, no lookup table.
         """
         if not isinstance(ir_x, NDArray) or ir_x.ndim != 1:
             raise ValueError("ir_x must be a one-dimensional numpy array")
@@ -64,10 +253,11 @@ class RandomizedIr:
         if L_true - self.L < 1e-6:
             self.L -= 1
 
+        self.base_ir_batched = ir_y_batched
         if callable(ir_y):
             self.base_ir_type = 'generated'
-            self.base_ir_generator: Callable[[], NDArray] = ir_y
-            ir_y_realization = self.base_ir_generator()
+            self.base_ir_generator: Callable[..., NDArray] = ir_y
+            ir_y_realization = self.generate_base_realizations(1)[:, 0]
         else:
             self.base_ir_type = 'frozen'
             self.base_ir_frozen = ir_y
@@ -76,6 +266,14 @@ class RandomizedIr:
             raise ValueError("ir_y must be or return numpy array of the same shape as ir_x")
         self.factor_generator = factor
 
+        self.lookup_step = lookup_step
+        if lookup_step is not None:
+            if self.base_ir_type != 'frozen':
+                raise ValueError("Lookup table can be used only with frozen ir_y")
+            lookup_steps_count = math.ceil(self.ir_x[-1] / lookup_step)
+            lookup_x = np.arange(lookup_steps_count + 1) * lookup_step
+            self.lookup_table = self._interp_realization(self.base_ir_frozen)(lookup_x)
+
     def _interp_realization(self, y):
         return interp1d(
             self.ir_x,
@@ -86,6 +284,22 @@ class RandomizedIr:
             bounds_error=False,
         )
 
+    def generate_base_realizations(self, count: int) -> NDArray[(Any, Any), float]:
+        """Stack of `count` base IR realizations as columns of (ir_x.size, count) array. Only for generated base IR"""
+        if self.base_ir_batched:
+            realizations = self.base_ir_generator(count)
+            if not isinstance(realizations, np.ndarray) or realizations.shape != (self.ir_x.size, count):
+                raise ValueError("ir_y must be or return numpy array of the same shape as ir_x")
+            return realizations
+        realizations = np.zeros((self.ir_x.size, count))
+        for i_realization in range(count):
+            realizations[:, i_realization] = self.base_ir_generator()
+        return realizations
+
+    def interp_realizations(self, x: NDArray[(Any, Any), float], ys: NDArray[(Any, Any), float]) -> NDArray:
+        """Evaluate a stack of base IR realizations (columns of ys) at query points (corresponding columns of x)"""
+        return utils.interp_columns(self.ir_x, ys, x)
+
     def __call__(self, x: NDArray) -> NDArray:
         """Evaluate randomized IR (i.e. its random realization) at given points
 
@@ -103,14 +317,14 @@ class RandomizedIr:
             factors = self.factor_generator(N_batch).reshape((1, N_batch))
         else:
             factors = np.ones((1, N_batch))
-        if self.base_ir_type == 'frozen':
+        if self.base_ir_type == 'frozen' and self.lookup_step is not None:
+            x_flat = np.ascontiguousarray(x, dtype=float).reshape(x.size)
+            y = lookup_ir(x_flat, self.lookup_table, self.lookup_step, self.ir_x[-1]).reshape((N_query, N_batch))
+        elif self.base_ir_type == 'frozen':
             realization_interp = self._interp_realization(self.base_ir_frozen)
             y = realization_interp(x).reshape((N_query, N_batch))
         elif self.base_ir_type == 'generated':
-            y = np.zeros((N_query, N_batch))
-            for i_batch, x_query in enumerate(x.T):
-                realization_interp = self._interp_realization(self.base_ir_generator())
-                y[:, i_batch] = realization_interp(x_query)
+            y = self.interp_realizations(x, self.generate_base_realizations(N_batch))
         return factors * y
 
     def plot_realizations(self, count: int = 10, ax: plt.Axes = None):
@@ -123,54 +337,502 @@ class RandomizedIr:
     def convolve_with_n_vec(
         self,
         n_vec: NDArray,
-        inbin_invcdf: Callable[[float], float] = None,
+        inbin_invcdf: Optional[InbinTimes] = None,
         debug_inbin_times: bool = False,
+        rireff: Optional['RandomizedIrEffect'] = None,
     ) -> NDArray:
         """Given a number of delta function in each bin, return their convolution with the RIR. Delta times are assumed
         to be equally distributed in each bin.
 
         Args:
             n_vec (NDArray): number of delta functions in each bin
-            inbin_invcdf (Callable[[float], float], optional): inverse CDF of delta time distribution inside one bin.
-                                                               Must have the followind properties: inbin_invcdf(0) = 0,
-                                                               inbin_invcdf(1) = 1, monotonous growth.
+            inbin_invcdf (Callable[[float], float] or InbinTimeDistribution, optional): inverse CDF of delta time
+                                                               distribution inside one bin. Must have the followind
+                                                               properties: inbin_invcdf(0) = 0, inbin_invcdf(1) = 1,
+                                                               monotonous growth. InbinTimeDistribution is sampled
+                                                               in bulk, plain function is called for each delta.
                                                                Defaults to None, interpreted as uniform distribution.
             debug_inbin_times (bool, optional): if True, print mean and std of inbin time distribution. Useful for
                                                 debugging inbin_invcdf. Defaults to False.
+            rireff (RandomizedIrEffect, optional): if given, signal is modelled approximately as mean IR convolution
+                                                   plus gaussian correction with moments from rireff, so that the cost
+                                                   scales with signal length instead of number of deltas. See
+                                                   RandomizedIrEffect.convolve_with_n_vec_approx. In-bin times
+                                                   distribution is taken from rireff, `inbin_invcdf` is ignored.
 
         Returns:
             NDArray: convoluted signal
         """
-        if not isinstance(n_vec, NDArray) or n_vec.ndim != 1 or n_vec.dtype != int:
+        # plain ndarray checks, nptyping isinstance is too slow for a hot simulation path
+        if not isinstance(n_vec, np.ndarray) or n_vec.ndim != 1 or n_vec.dtype != int:
             raise ValueError("n_vec must be one dimensional numpy array of integers")
+        if np.any(n_vec < 0):
+            raise ValueError("n_vec must be non-negative")
+        if rireff is not None:
+            if rireff.rir is not self:
+                raise ValueError("rireff must be created for this RandomizedIr")
+            return rireff.convolve_with_n_vec_approx(n_vec)
+        return self._convolve_with_n_mat(
+            n_vec.reshape((1, n_vec.size)), inbin_invcdf=inbin_invcdf, debug_inbin_times=debug_inbin_times
+        )[0, :]
+
+    def convolve_with_n_mat(
+        self,
+        n_mat: NDArray[(Any, Any), int],
+        inbin_invcdf: Optional[InbinTimes] = None,
+        debug_inbin_times: bool = False,
+    ) -> NDArray[(Any, Any), float]:
+        """Bulk version of convolve_with_n_vec: simulate many signals at once, e.g. all channels of a frame.
+        All in-bin times and RIR realizations are drawn in one go and contributions are scatter-added to the output.
+
+        Args:
+            n_mat (NDArray[(N_signals, N), int]): number of delta functions in each bin, one row per signal
+            inbin_invcdf, debug_inbin_times: see convolve_with_n_vec
 
+        Returns:
+            NDArray[(N_signals, N + L), float]: convoluted signals, one row per n_mat row
+        """
+        if not isinstance(n_mat, np.ndarray) or n_mat.ndim != 2 or n_mat.dtype != int:
+            raise ValueError("n_mat must be two dimensional numpy array of integers")
+        if np.any(n_mat < 0):
+            raise ValueError("n_mat must be non-negative")
+        return self._convolve_with_n_mat(n_mat, inbin_invcdf=inbin_invcdf, debug_inbin_times=debug_inbin_times)
+
+    def _convolve_with_n_mat(
+        self,
+        n_mat: NDArray[(Any, Any), int],
+        inbin_invcdf: Optional[InbinTimes] = None,
+        debug_inbin_times: bool = False,
+    ) -> NDArray[(Any, Any), float]:
+        """convolve_with_n_mat without input validation"""
         if debug_inbin_times and inbin_invcdf is not None:
             n_test_sample = 10000
-            sample = np.vectorize(inbin_invcdf)(rng.random(size=(n_test_sample,)))
+            sample = sample_inbin_times(inbin_invcdf, size=(n_test_sample,))
             print(f"Inbin times are distributed with mean = {sample.mean():.3f} and sigma={sample.std():.3f}")
 
-        N = n_vec.size
-
+        N_signals, N = n_mat.shape
         convoluted_pts_count = N + self.L
-        out_y = np.zeros((convoluted_pts_count,))
 
-        ir_x_whole_bins = np.arange(0, self.L, step=1.0)
+        # one entry per delta function: index of its bin in the flattened (N_signals, N + L) output
+        n_flat = n_mat.reshape(n_mat.size)
+        signal_indices, bin_indices = np.divmod(np.arange(n_flat.size), N)
+        delta_out_offsets = np.repeat(signal_indices * convoluted_pts_count + bin_indices, n_flat)
+        n_deltas = delta_out_offsets.size
+
+        inbin_times = sample_inbin_times(inbin_invcdf, size=(1, n_deltas))
+        # lags 0, ..., L, same as in RandomizedIrEffect model; delta in the last bin reaches the last output bin
+        ir_x_whole_bins = np.arange(0, self.L + 1, step=1.0).reshape((self.L + 1, 1))
+        contributions = self(ir_x_whole_bins + (1 - inbin_times))  # (L + 1, n_deltas), new realization for each delta
+
+        out_indices = delta_out_offsets.reshape((1, n_deltas)) + ir_x_whole_bins.astype(int)
+        out_y = np.bincount(
+            out_indices.reshape(out_indices.size),
+            weights=contributions.reshape(contributions.size),
+            minlength=N_signals * convoluted_pts_count,
+        )
+        out_y = out_y.astype(float, copy=False)  # bincount returns integers when there are no deltas at all
+        return out_y.reshape((N_signals, convoluted_pts_count))
+
+
+def _callable_identity(func: Callable, cache_id: Optional[str]) -> str:
+    """Stable identity of a callable for cache keys. Only plain module-level functions are identified by name: for
+    lambdas, local functions, partials, bound methods (e.g. frozen scipy distribution's rvs) and callable instances
+    the name doesn't capture parameters, so explicit cache_id is required"""
+    func_id = f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', type(func).__qualname__)}"
+    if not inspect.isfunction(func) or '<lambda>' in func_id or '<locals>' in func_id:
+        if cache_id is None:
+            raise ValueError(f"Can't identify {func_id} for caching, pass explicit cache_id")
+        return ''
+    return func_id
+
+
+def _atomic_save(path: Path, save_func: Callable[[Any], None]):
+    """Save file with a given function under temporary name and then move it in place, so that concurrent
+    readers never see partially written file"""
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        save_func(f)
+    os.replace(tmp_path, path)
+
+
+MAX_CUMULANT_ORDER = 4
+
+
+def cumulants_from_raw_moments(raw_moments: NDArray[(Any, Any), float]) -> NDArray[(Any, Any), float]:
+    """Cumulants of orders 1, ..., K <= 4 from raw moments E[X], ..., E[X^K], stacked along the first axis"""
+    m = [None] + list(raw_moments)
+    cumulants = [
+        lambda: m[1],
+        lambda: m[2] - m[1] ** 2,
+        lambda: m[3] - 3 * m[2] * m[1] + 2 * m[1] ** 3,
+        lambda: m[4] - 4 * m[3] * m[1] - 3 * m[2] ** 2 + 12 * m[2] * m[1] ** 2 - 6 * m[1] ** 4,
+    ]
+    return np.array([cumulant() for cumulant in cumulants[: len(raw_moments)]])
+
+
+def raw_moments_from_cumulants(cumulants: NDArray[(Any, Any), float]) -> NDArray[(Any, Any), float]:
+    """Inverse of cumulants_from_raw_moments"""
+    k = [None] + list(cumulants)
+    raw_moments = [
+        lambda: k[1],
+        lambda: k[2] + k[1] ** 2,
+        lambda: k[3] + 3 * k[2] * k[1] + k[1] ** 3,
+        lambda: k[4] + 4 * k[3] * k[1] + 3 * k[2] ** 2 + 6 * k[2] * k[1] ** 2 + k[1] ** 4,
+    ]
+    return np.array([raw_moment() for raw_moment in raw_moments[: len(cumulants)]])
+
+
+class _SampleMomentsAccumulator:
+    """Online (Welford-style) accumulation of mean and covariance matrix over chunks of column-vectors sample.
+    Power sums for raw moments of each component up to MAX_CUMULANT_ORDER are accumulated as well."""
+
+    def __init__(self, dim: int):
+        self.count = 0
+        self.mean = np.zeros((dim,))
+        self.M2 = np.zeros((dim, dim))  # sum of outer products of deviations from the mean
+        self.power_sums = np.zeros((MAX_CUMULANT_ORDER, dim))
+
+    def add(self, chunk: NDArray[(Any, Any), float]):
+        chunk_count = chunk.shape[1]
+        chunk_mean = np.mean(chunk, axis=1)
+        chunk_centered = chunk - chunk_mean.reshape((chunk_mean.size, 1))
+        # Chan et al. pairwise update for merging two sets of statistics
+        delta = chunk_mean - self.mean
+        total_count = self.count + chunk_count
+        self.mean += delta * chunk_count / total_count
+        self.M2 += chunk_centered @ chunk_centered.T + np.outer(delta, delta) * self.count * chunk_count / total_count
+        self.count = total_count
+        chunk_power = np.ones_like(chunk)
+        for order in range(MAX_CUMULANT_ORDER):
+            chunk_power *= chunk
+            self.power_sums[order] += np.sum(chunk_power, axis=1)
 
-        for i, n_i in enumerate(n_vec):
-            for _ in range(n_i):
-                uniform_sample = rng.random()
-                inbin_time = inbin_invcdf(uniform_sample) if inbin_invcdf else uniform_sample
-                out_y[i : (i + self.L)] += self(ir_x_whole_bins + (1 - inbin_time))[:, 0]  # noqa
-        return out_y
+    @property
+    def D(self) -> NDArray[(Any,), float]:
+        """Same as np.power(np.std(sample, axis=1), 2)"""
+        return np.diag(self.M2) / self.count
+
+    @property
+    def cov(self) -> NDArray[(Any, Any), float]:
+        """Same as np.cov(sample)"""
+        return self.M2 / (self.count - 1)
+
+    @property
+    def raw_moments(self) -> NDArray[(Any, Any), float]:
+        """Raw moments of each component, (MAX_CUMULANT_ORDER, dim)"""
+        return self.power_sums / self.count
+
+
+# compiled likelihood kernels: data is passed as arguments instead of being captured in closures, so that machine
+# code is compiled once and cached on disk; RandomizedIrEffect.get_* methods return thin wrappers around them
+
+
+@njit(cache=True)
+def mvn_mu_Sigma_kernel(
+    n_vec: NDArray[(Any,), float], C_mat: NDArray[(Any, Any), float], Xi_mat: NDArray[(Any, Any), float], L: int, N: int
+):
+    """See RandomizedIrEffect.get_mvn_mu_Sigma_from_n_vec"""
+    # mean vector calculation
+    mu = C_mat @ n_vec
+    # covariance matrix calculation
+    Sigma = np.zeros((N - L, N - L))
+    for i_cut in range(N - L):
+        i = i_cut + L + 1
+        # see \\ref{eq:Xi-matrix-for-Sigma-calculation}
+        Sigma_i_vec = Xi_mat @ n_vec[i_cut:i]  # noqa
+        # cutting end of Sigma_i vec when adding it at the end of the matrix (no effect on the inside-region)
+        Sigma_i_vec = Sigma_i_vec[: N - L - i_cut]
+        Sigma[i_cut, i_cut:i] = Sigma_i_vec
+        Sigma[i_cut:i, i_cut] = Sigma_i_vec
+    return mu, Sigma
+
+
+@njit(cache=True)
+def loglikelihood_mvn_banded_kernel(
+    n_vec: NDArray[(Any,), float],
+    s_vec: NDArray[(Any,), float],
+    delta: float,
+    density: bool,
+    uniforms: NDArray[(Any, Any), float],
+    C_mat: NDArray[(Any, Any), float],
+    Xi_mat: NDArray[(Any, Any), float],
+    L: int,
+    N: int,
+) -> float:
+    """See RandomizedIrEffect.get_loglikelihood_mvn_banded; s_vec is sliced of edge effects. Box probability is
+    approximated with midpoint rule if uniforms for GHK are empty."""
+    if np.any(n_vec < 0):  # guard for impossible values
+        return -np.inf
+    mu, Sigma_band = banded_mvn.mvn_mu_Sigma_band(n_vec, C_mat, Xi_mat, L, N)
+    if density:
+        return banded_mvn.logpdf(s_vec, mu, Sigma_band)
+    elif uniforms.shape[0] == 0:
+        return banded_mvn.logpdf(s_vec + delta / 2, mu, Sigma_band) + s_vec.size * np.log(delta)
+    else:
+        return banded_mvn.ghk_log_box_probability(s_vec, s_vec + delta, mu, Sigma_band, uniforms)
+
+
+@njit(cache=True)
+def loglikelihood_mvn_banded_value_and_grad_kernel(
+    n_vec: NDArray[(Any,), float],
+    s_vec: NDArray[(Any,), float],
+    delta: float,
+    density: bool,
+    C_mat: NDArray[(Any, Any), float],
+    Xi_mat: NDArray[(Any, Any), float],
+    L: int,
+    N: int,
+) -> Tuple[float, NDArray[(Any,), float]]:
+    """loglikelihood_mvn_banded_kernel with midpoint rule for box probability and its gradient w.r.t. n_vec. Both mu
+    and Sigma are linear in n_vec, so gradient is chained from banded_mvn.logpdf_value_and_grad exactly."""
+    grad = np.zeros(n_vec.size)
+    if np.any(n_vec < 0):  # guard for impossible values
+        return -np.inf, grad
+    mu, Sigma_band = banded_mvn.mvn_mu_Sigma_band(n_vec, C_mat, Xi_mat, L, N)
+    if density:
+        logL, grad_mu, grad_Sigma_band = banded_mvn.logpdf_value_and_grad(s_vec, mu, Sigma_band)
+    else:
+        logL, grad_mu, grad_Sigma_band = banded_mvn.logpdf_value_and_grad(s_vec + delta / 2, mu, Sigma_band)
+        logL += s_vec.size * np.log(delta)
+    if np.isinf(logL):
+        return logL, grad
+    grad += C_mat.T @ grad_mu
+    # Sigma_band[d, i_cut] = sum over k of Xi_mat[d, k] * n_vec[i_cut + k], see banded_mvn.mvn_mu_Sigma_band
+    for i_cut in range(N - L):
+        for d in range(L + 1):
+            grad_Sigma_d = grad_Sigma_band[d, i_cut]
+            for k in range(L + 1):
+                grad[i_cut + k] += Xi_mat[d, k] * grad_Sigma_d
+    return logL, grad
+
+
+@njit(parallel=True, cache=True)
+def loglikelihood_mvn_banded_batch_kernel(
+    n_mat: NDArray[(Any, Any), float],
+    s_vec: NDArray[(Any,), float],
+    delta: float,
+    density: bool,
+    uniforms: NDArray[(Any, Any), float],
+    C_mat: NDArray[(Any, Any), float],
+    Xi_mat: NDArray[(Any, Any), float],
+    L: int,
+    N: int,
+) -> NDArray[(Any,), float]:
+    """loglikelihood_mvn_banded_kernel for each row of n_mat, in parallel"""
+    W = n_mat.shape[0]
+    loglikes = np.empty(W)
+    for w in prange(W):
+        loglikes[w] = loglikelihood_mvn_banded_kernel(n_mat[w], s_vec, delta, density, uniforms, C_mat, Xi_mat, L, N)
+    return loglikes
+
+
+@njit(cache=True)
+def loglikelihood_normdist_kernel(
+    n_vec: NDArray[(Any,), float],
+    s_vec: NDArray[(Any,), float],
+    delta: float,
+    density: bool,
+    ir_sample_mean: NDArray[(Any,), float],
+    ir_sample_D: NDArray[(Any,), float],
+    L: int,
+) -> float:
+    """See RandomizedIrEffect.get_loglikelihood_independent_normdist"""
+    if np.any(n_vec < 0):  # guard for impossible values
+        return -np.inf
+    N = s_vec.size - L
+    logL = 0.0
+    for j, s_j in enumerate(s_vec):
+        j += 1  # from indexing array (0-based) to indexing time points (1-based)
+        if j <= L or j > N:  # cutting off signal edges
+            continue
+        Es_j = 0.0
+        Ds_j = 0.0
+        for lag in range(L + 1):
+            i = j - lag
+            i -= 1  # from indexing bins (1-based) to indexing array (0-based)
+            Es_j += n_vec[i] * ir_sample_mean[lag]
+            Ds_j += n_vec[i] * ir_sample_D[lag]
+        sigma_s_j = np.sqrt(Ds_j)
+        if density:
+            logL_addition = (
+                -0.918938533205  # log(sqrt(2 pi))
+                - np.log(sigma_s_j)
+                - ((s_j - Es_j) / (1.41421356237 * sigma_s_j)) ** 2
+            )
+        else:
+            logL_addition = np.log(norm_cdf((s_j + delta - Es_j) / sigma_s_j) - norm_cdf((s_j - Es_j) / sigma_s_j))
+        if np.isnan(logL_addition):
+            return -np.inf
+        logL += logL_addition
+    return logL
+
+
+@njit(cache=True)
+def loglikelihood_normdist_value_and_grad_kernel(
+    n_vec: NDArray[(Any,), float],
+    s_vec: NDArray[(Any,), float],
+    delta: float,
+    density: bool,
+    ir_sample_mean: NDArray[(Any,), float],
+    ir_sample_D: NDArray[(Any,), float],
+    L: int,
+) -> Tuple[float, NDArray[(Any,), float]]:
+    """loglikelihood_normdist_kernel and its gradient w.r.t. n_vec. Mean and variance of each S_j are linear in
+    n_vec, so gradient is accumulated from derivatives of each term w.r.t. them."""
+    grad = np.zeros(n_vec.size)
+    if np.any(n_vec < 0):  # guard for impossible values
+        return -np.inf, grad
+    N = s_vec.size - L
+    logL = 0.0
+    for j in range(L, N):  # cutting off signal edges, j is 0-based index of time point
+        Es_j = 0.0
+        Ds_j = 0.0
+        for lag in range(L + 1):
+            Es_j += n_vec[j - lag] * ir_sample_mean[lag]
+            Ds_j += n_vec[j - lag] * ir_sample_D[lag]
+        if not Ds_j > 0:
+            return -np.inf, np.zeros(n_vec.size)
+        sigma_s_j = np.sqrt(Ds_j)
+        if density:
+            z = (s_vec[j] - Es_j) / sigma_s_j
+            logL_addition = -0.918938533205 - np.log(sigma_s_j) - 0.5 * z ** 2  # log(sqrt(2 pi)) = 0.9189...
+            dlogL_dE = z / sigma_s_j
+            dlogL_dD = 0.5 * (z ** 2 - 1) / Ds_j
+        else:
+            z_lower = (s_vec[j] - Es_j) / sigma_s_j
+            z_upper = (s_vec[j] + delta - Es_j) / sigma_s_j
+            p = norm_cdf(z_upper) - norm_cdf(z_lower)
+            if not p > 0:  # box probability underflow, gradient is undefined
+                return -np.inf, np.zeros(n_vec.size)
+            logL_addition = np.log(p)
+            pdf_lower = np.exp(-0.5 * z_lower ** 2) / SQRT_2PI
+            pdf_upper = np.exp(-0.5 * z_upper ** 2) / SQRT_2PI
+            dlogL_dE = (pdf_lower - pdf_upper) / (p * sigma_s_j)
+            dlogL_dD = (pdf_lower * z_lower - pdf_upper * z_upper) / (2 * p * Ds_j)
+        if np.isnan(logL_addition):
+            return -np.inf, np.zeros(n_vec.size)
+        logL += logL_addition
+        for lag in range(L + 1):
+            grad[j - lag] += dlogL_dE * ir_sample_mean[lag] + dlogL_dD * ir_sample_D[lag]
+    return logL, grad
+
+
+@njit(parallel=True, cache=True)
+def loglikelihood_normdist_batch_kernel(
+    n_mat: NDArray[(Any, Any), float],
+    s_vec: NDArray[(Any,), float],
+    delta: float,
+    density: bool,
+    ir_sample_mean: NDArray[(Any,), float],
+    ir_sample_D: NDArray[(Any,), float],
+    L: int,
+) -> NDArray[(Any,), float]:
+    """loglikelihood_normdist_kernel for each row of n_mat, in parallel"""
+    W = n_mat.shape[0]
+    loglikes = np.empty(W)
+    for w in prange(W):
+        loglikes[w] = loglikelihood_normdist_kernel(n_mat[w], s_vec, delta, density, ir_sample_mean, ir_sample_D, L)
+    return loglikes
+
+
+@njit(cache=True)
+def loglikelihood_edgeworth_kernel(
+    n_vec: NDArray[(Any,), float],
+    s_vec: NDArray[(Any,), float],
+    delta: float,
+    density: bool,
+    ir_cumulants: NDArray[(Any, Any), float],
+    L: int,
+) -> float:
+    """See RandomizedIrEffect.get_loglikelihood_edgeworth; ir_cumulants must contain all MAX_CUMULANT_ORDER rows"""
+    if np.any(n_vec < 0):  # guard for impossible values
+        return -np.inf
+    N = s_vec.size - L
+    logL = 0.0
+    for j in range(L, N):  # cutting off signal edges, j is 0-based index of time point
+        mu = 0.0
+        D = 0.0
+        kappa_3 = 0.0
+        kappa_4 = 0.0
+        for lag in range(L + 1):
+            n_i = n_vec[j - lag]
+            mu += n_i * ir_cumulants[0, lag]
+            D += n_i * ir_cumulants[1, lag]
+            kappa_3 += n_i * ir_cumulants[2, lag]
+            kappa_4 += n_i * ir_cumulants[3, lag]
+        if not D > 0:  # degenerate S_j (e.g. no photoelectrons in the window), density is undefined
+            return -np.inf
+        sigma = np.sqrt(D)
+        gamma_1 = kappa_3 / sigma ** 3
+        gamma_2 = kappa_4 / sigma ** 4
+        if density:
+            z = (s_vec[j] - mu) / sigma
+            p = edgeworth_pdf(z, gamma_1, gamma_2) / sigma
+            if not p > 0:  # normal approximation fallback, see get_loglikelihood_edgeworth
+                p = np.exp(-0.5 * z ** 2) / (SQRT_2PI * sigma)
+        else:
+            z_lower = (s_vec[j] - mu) / sigma
+            z_upper = (s_vec[j] + delta - mu) / sigma
+            p = edgeworth_cdf(z_upper, gamma_1, gamma_2) - edgeworth_cdf(z_lower, gamma_1, gamma_2)
+            if not p > 0:  # normal approximation fallback, see get_loglikelihood_edgeworth
+                p = norm_cdf(z_upper) - norm_cdf(z_lower)
+        logL_addition = np.log(p)
+        if np.isnan(logL_addition):
+            return -np.inf
+        logL += logL_addition
+    return logL
+
+
+@dataclass
+class LaplaceApproximation:
+    """Normal approximation of the posterior around its mode truncated to n >= 0, see
+    RandomizedIrEffect.get_laplace_approximation"""
+
+    mode: NDArray[(Any,), float]
+    cov: NDArray[(Any, Any), float]
+    loglike_at_mode: float
+    # location of the normal before truncation; below zero in bins where the mode is at n = 0 bound
+    loc: NDArray[(Any,), float]
+
+    GIBBS_SWEEPS = 10
+
+    def sample(self, n_samples: int, seed: Optional[int] = None) -> NDArray[(Any, Any), float]:
+        """(n_samples, N) sample from the truncated normal. Independent Gibbs chains (Geweke, 1991) are started from
+        untruncated normal draws clipped at zero, each contributing its state after GIBBS_SWEEPS coordinate sweeps"""
+        sample_rng = np.random.default_rng(seed)
+        # eigendecomposition instead of Cholesky to tolerate numerically degenerate cov
+        eigvals, eigvecs = np.linalg.eigh(self.cov)
+        A = eigvecs * np.sqrt(np.clip(eigvals, 0, None))
+        sample = np.clip(self.loc + sample_rng.normal(size=(n_samples, self.loc.size)) @ A.T, 0, None)
+
+        precision = np.linalg.inv(self.cov)
+        conditional_scale = 1 / np.sqrt(np.diag(precision))
+        for _ in range(self.GIBBS_SWEEPS):
+            for i in range(self.loc.size):
+                # x_i | x_{-i} is normal with precision Q_ii and mean loc_i - sum_{j != i} Q_ij (x_j - loc_j) / Q_ii
+                deviation = sample - self.loc
+                deviation[:, i] = 0
+                conditional_mean = self.loc[i] - (deviation @ precision[:, i]) / precision[i, i]
+                sample[:, i] = truncnorm.rvs(
+                    -conditional_mean / conditional_scale[i],
+                    np.inf,
+                    loc=conditional_mean,
+                    scale=conditional_scale[i],
+                    random_state=sample_rng,
+                )
+        return sample
 
 
 class RandomizedIrEffect:
+    MOMENTS_CHUNKSIZE = 10 ** 5
+
     def __init__(
         self,
         rir: RandomizedIr,
         N: int,
         samplesize: int = 100000,
-        inbin_invcdf: Callable[[float], float] = None,
+        inbin_invcdf: Optional[InbinTimes] = None,
+        chunksize: Optional[int] = None,
     ):
         """Statistical representation of a RandomizedIr's effect in linear system.
 
@@ -178,31 +840,236 @@ class RandomizedIrEffect:
             rir (RandomizedIr): RandomizedIr for calculation.
             N (int): Number of bins we're operating in.
             samplesize (int, optional): Amount of sample functions for each IR bin. Defaults to 100000.
-            inbin_invcdf (Callable[[float], float], optional): See RanodmizedIr's convolve_with_deltas method.
+            inbin_invcdf (Callable[[float], float] or InbinTimeDistribution, optional): See RanodmizedIr's
+                                                                                       convolve_with_n_vec method.
+            chunksize (int, optional): if given, sample functions are generated in chunks of this size and only their
+                                       moments are accumulated, so that peak memory does not depend on samplesize.
+                                       ir_samples is not stored in this case and methods using it (Monte-Carlo
+                                       likelihood, MGF) are not available. Defaults to None, whole sample is stored.
         """
         self.rir = rir
         self.N = N
-        self.ir_samples = np.zeros((self.L + 1, samplesize))
+        self.inbin_invcdf = inbin_invcdf
+        self.samplesize = samplesize
+
+        moments = _SampleMomentsAccumulator(self.L + 1)
+        if chunksize is None:
+            self.ir_samples = self.generate_ir_samples(samplesize)
+            # single pass over stored sample, chunked only to avoid a full-size centered copy
+            for chunk_start in range(0, samplesize, self.MOMENTS_CHUNKSIZE):
+                moments.add(self.ir_samples[:, chunk_start : chunk_start + self.MOMENTS_CHUNKSIZE])  # noqa
+        else:
+            self.ir_samples = None
+            for chunk_start in range(0, samplesize, chunksize):
+                moments.add(self.generate_ir_samples(min(chunksize, samplesize - chunk_start)))
+        # means and dispersions of C(1, l) and covariance matrix of C(1, l) for l = 0, ..., L
+        self.ir_sample_mean = moments.mean
+        self.ir_sample_D = moments.D
+        self.ir_sample_cov = moments.cov
+        self.ir_cumulants = cumulants_from_raw_moments(moments.raw_moments)
+
+        self._calculate_matrices()
+
+    @classmethod
+    def from_factor_moments(
+        cls,
+        rir: RandomizedIr,
+        N: int,
+        factor_moments: Sequence[float],
+        inbin_invcdf: Optional[InbinTimes] = None,
+        n_quadrature_pts: int = 1000,
+    ) -> 'RandomizedIrEffect':
+        """Semi-analytic alternative to sampling for factorized RIRs, i.e. random factor times frozen IR shape.
+        Sample function for lag l is factor * shape(l + t) with in-bin time t, so their means and covariances
+        factorize into factor moments and integrals of the shape over t, which are calculated by quadrature.
+        No sampling noise, and ir_samples is not available, as in chunked mode.
 
-        if inbin_invcdf is not None:
-            inbin_invcdf = np.vectorize(inbin_invcdf)
-        uniform_sample = rng.random(size=(1, samplesize))
-        inbin_time_offsets = inbin_invcdf(uniform_sample) if inbin_invcdf else uniform_sample
-        sample_ts = np.arange(start=0, stop=self.L + 1, step=1.0)
-        sample_ts = sample_ts.reshape((sample_ts.size, 1))
-        sample_ts = np.tile(sample_ts, reps=(1, samplesize))
-        sample_ts = sample_ts + inbin_time_offsets
-        self.ir_samples = rir(sample_ts)
+        Args:
+            rir (RandomizedIr): RandomizedIr with frozen ir_y. Its factor generator is not used.
+            N (int): Number of bins we're operating in.
+            factor_moments (Sequence[float]): raw moments of the factor distribution E[f], E[f^2], ...; at least two.
+                                              Use [1, 1, 1, 1] for RandomizedIr without factor. Cumulants
+                                              table (see mgf_moment) is calculated up to the order of the last
+                                              given moment.
+            inbin_invcdf (Callable[[float], float] or InbinTimeDistribution, optional): See RanodmizedIr's
+                                                                                       convolve_with_n_vec method.
+            n_quadrature_pts (int, optional): number of in-bin time quantiles for quadrature. Defaults to 1000.
+        """
+        if rir.base_ir_type != 'frozen':
+            raise ValueError("Semi-analytic RandomizedIrEffect can be calculated only for frozen ir_y")
+        if len(factor_moments) < 2:
+            raise ValueError("At least two factor moments are required")
+
+        self = cls.__new__(cls)
+        self.rir = rir
+        self.N = N
+        self.inbin_invcdf = inbin_invcdf
+        self.samplesize = None
+        self.ir_samples = None
+
+        # midpoint rule over in-bin time quantiles: each point carries equal probability
+        uniform_quantiles = (np.arange(n_quadrature_pts) + 0.5) / n_quadrature_pts
+        if inbin_invcdf is None:
+            inbin_times = uniform_quantiles
+        elif isinstance(inbin_invcdf, InbinTimeDistribution):
+            inbin_times = inbin_invcdf(uniform_quantiles)
+        else:
+            inbin_times = np.vectorize(inbin_invcdf)(uniform_quantiles)
+        shape_ts = np.arange(start=0, stop=self.L + 1, step=1.0).reshape((self.L + 1, 1)) + inbin_times
+        shape_vals = rir._interp_realization(rir.base_ir_frozen)(shape_ts)  # (L + 1, n_quadrature_pts)
+
+        factor_mean, factor_second_moment = factor_moments[:2]
+        self.ir_sample_mean = factor_mean * np.mean(shape_vals, axis=1)
+        ir_sample_second_moments = factor_second_moment * (shape_vals @ shape_vals.T) / n_quadrature_pts
+        self.ir_sample_cov = ir_sample_second_moments - np.outer(self.ir_sample_mean, self.ir_sample_mean)
+        self.ir_sample_D = np.diag(self.ir_sample_cov).copy()
+        max_order = min(len(factor_moments), MAX_CUMULANT_ORDER)
+        ir_sample_raw_moments = np.array(
+            [factor_moments[order - 1] * np.mean(shape_vals ** order, axis=1) for order in range(1, max_order + 1)]
+        )
+        self.ir_cumulants = cumulants_from_raw_moments(ir_sample_raw_moments)
+
+        self._calculate_matrices()
+        return self
+
+    # persistent cache
+
+    MOMENTS_FILENAME = 'moments.npz'
+    CACHE_FORMAT_VERSION = 2  # bump when saved fields change, so that stale cache entries are not loaded
+    SAMPLES_FILENAME = 'ir_samples.npy'
+
+    def save(self, directory: Path, save_samples: bool = True):
+        """Save calculated moments and matrices (and optionally ir_samples) to a given directory, see load"""
+        directory.mkdir(parents=True, exist_ok=True)
+        if save_samples and self.ir_samples is not None:
+            _atomic_save(directory / self.SAMPLES_FILENAME, partial(np.save, arr=self.ir_samples))
+        # moments are saved last and mark the cache entry as complete
+        _atomic_save(
+            directory / self.MOMENTS_FILENAME,
+            partial(
+                np.savez,
+                N=self.N,
+                samplesize=-1 if self.samplesize is None else self.samplesize,
+                ir_sample_mean=self.ir_sample_mean,
+                ir_sample_D=self.ir_sample_D,
+                ir_sample_cov=self.ir_sample_cov,
+                ir_cumulants=self.ir_cumulants,
+                C_mat=self.C_mat,
+                C_mat_pinv=self.C_mat_pinv,
+                Xi_mat=self.Xi_mat,
+            ),
+        )
 
-        # means and dispersions of C(1, l)
-        self.ir_sample_mean = np.mean(self.ir_samples, axis=1)
-        self.ir_sample_D = np.power(np.std(self.ir_samples, axis=1), 2)
+    @classmethod
+    def load(
+        cls, directory: Path, rir: RandomizedIr, inbin_invcdf: Optional[InbinTimes] = None
+    ) -> 'RandomizedIrEffect':
+        """Load RandomizedIrEffect saved with save method. ir_samples, if saved, are memory-mapped read-only.
+        rir and inbin_invcdf are not saved and must be the same as for the saved object."""
+        moments = np.load(directory / cls.MOMENTS_FILENAME)
+        if rir.L + 1 != moments['ir_sample_mean'].size:
+            raise ValueError("Saved RandomizedIrEffect was calculated for RandomizedIr with different L")
+        self = cls.__new__(cls)
+        self.rir = rir
+        self.N = int(moments['N'])
+        self.inbin_invcdf = inbin_invcdf
+        samplesize = int(moments['samplesize'])
+        self.samplesize = None if samplesize == -1 else samplesize
+        samples_path = directory / cls.SAMPLES_FILENAME
+        self.ir_samples = np.load(samples_path, mmap_mode='r') if samples_path.exists() else None
+        self.ir_sample_mean = moments['ir_sample_mean']
+        self.ir_sample_D = moments['ir_sample_D']
+        self.ir_sample_cov = moments['ir_sample_cov']
+        self.ir_cumulants = moments['ir_cumulants']
+        self.C_mat = moments['C_mat']
+        self.C_mat_pinv = moments['C_mat_pinv']
+        self.Xi_mat = moments['Xi_mat']
+        self._prepare_mvn_mu_Sigma()
+        return self
+
+    @classmethod
+    def cached(
+        cls,
+        cache_dir: Path,
+        rir: RandomizedIr,
+        N: int,
+        samplesize: int = 100000,
+        inbin_invcdf: Optional[InbinTimes] = None,
+        chunksize: Optional[int] = None,
+        save_samples: bool = True,
+        cache_id: Optional[str] = None,
+    ) -> 'RandomizedIrEffect':
+        """Same as RandomizedIrEffect constructor, but the result is stored in cache_dir and loaded from there on
+        subsequent calls. Cache entry is identified by the content of ir_x and ir_y, identity of the factor, ir_y
+        generator and in-bin time distribution, N and samplesize.
+
+        Args:
+            cache_dir (Path): cache root directory, each entry is stored in its own subdirectory
+            rir, N, samplesize, inbin_invcdf, chunksize: see RandomizedIrEffect constructor
+            save_samples (bool, optional): store ir_samples in cache as well; they are memory-mapped when loaded.
+                                           Defaults to True.
+            cache_id (str, optional): explicit identity for callables that can't be identified by name (anything
+                                      but plain module-level functions, e.g. lambdas, partials, bound methods),
+                                      required if any of them is used. Defaults to None.
+        """
+        key = cls.cache_key(rir, N, samplesize, inbin_invcdf, cache_id)
+        entry_dir = Path(cache_dir) / key
+        if (entry_dir / cls.MOMENTS_FILENAME).exists():
+            return cls.load(entry_dir, rir, inbin_invcdf)
+        rireff = cls(rir, N, samplesize=samplesize, inbin_invcdf=inbin_invcdf, chunksize=chunksize)
+        rireff.save(entry_dir, save_samples=save_samples)
+        return rireff
+
+    @staticmethod
+    def cache_key(
+        rir: RandomizedIr,
+        N: int,
+        samplesize: int,
+        inbin_invcdf: Optional[InbinTimes] = None,
+        cache_id: Optional[str] = None,
+    ) -> str:
+        key_hash = hashlib.sha256()
+        key_hash.update(np.ascontiguousarray(rir.ir_x, dtype=float).tobytes())
+        if rir.base_ir_type == 'frozen':
+            key_hash.update(np.ascontiguousarray(rir.base_ir_frozen, dtype=float).tobytes())
+        else:
+            key_hash.update(_callable_identity(rir.base_ir_generator, cache_id).encode())
+        if rir.factor_generator is not None:
+            key_hash.update(_callable_identity(rir.factor_generator, cache_id).encode())
+        if isinstance(inbin_invcdf, InbinTimeDistribution):
+            key_hash.update(inbin_invcdf.t.tobytes())
+            key_hash.update(inbin_invcdf.cdf.tobytes())
+        elif inbin_invcdf is not None:
+            key_hash.update(_callable_identity(inbin_invcdf, cache_id).encode())
+        key_hash.update(f"N={N};samplesize={samplesize};cache_id={cache_id}".encode())
+        key_hash.update(f"format={RandomizedIrEffect.CACHE_FORMAT_VERSION}".encode())
+        return key_hash.hexdigest()[:32]
+
+    def _calculate_matrices(self):
         self.C_mat = self.calculate_C_mat()
         self.C_mat_pinv = pinv(self.C_mat)
         self.Xi_mat = self.calculate_Xi_mat()
+        self._prepare_mvn_mu_Sigma()
+
+    def _prepare_mvn_mu_Sigma(self):
         self.mvn_mu_Sigma_as_func_of_n_vec = self.get_mvn_mu_Sigma_from_n_vec()
         # run njitted func once to let numba compile it (avoid skewing timing tests later!)
-        self.mvn_mu_Sigma_as_func_of_n_vec(10 * np.ones(N, dtype=float))
+        self.mvn_mu_Sigma_as_func_of_n_vec(10 * np.ones(self.N, dtype=float))
+
+    def generate_ir_samples(self, samplesize: int) -> NDArray[(Any, Any), float]:
+        """Sample functions C(1, l) for l = 0, ..., L as (L + 1, samplesize) matrix"""
+        inbin_time_offsets = sample_inbin_times(self.inbin_invcdf, size=(1, samplesize))
+        sample_ts = np.arange(start=0, stop=self.L + 1, step=1.0)
+        sample_ts = sample_ts.reshape((sample_ts.size, 1))
+        sample_ts = np.tile(sample_ts, reps=(1, samplesize))
+        sample_ts = sample_ts + inbin_time_offsets
+        return self.rir(sample_ts)
+
+    def _check_ir_samples_stored(self):
+        if self.ir_samples is None:
+            raise ValueError(
+                "ir_samples are not stored for this RandomizedIrEffect, it was created in chunked or semi-analytic mode"
+            )
 
     def explore(self):
         print(f"L={self.L} and N={self.N}")
@@ -235,18 +1102,38 @@ class RandomizedIrEffect:
         """Matrix used to calculate covariance matrix for a given \\vec{n}
 
         See \\ref{eq:Xi-matrix-for-Sigma-calculation}"""
+        # Xi_{i, j} = cov(C(1, L - j), C(1, L - j + i)) for j >= i, all taken from the precomputed covariance matrix
+        L = self.L
+        Xi_mat = np.zeros((L + 1, L + 1))
+        i, j = np.triu_indices(L + 1)
+        Xi_mat[i, j] = self.ir_sample_cov[L - j, L - j + i]
+        return Xi_mat
 
-        def xi(lag, Delta):
-            # np.cov returns covariation _matrix_, but we need only cov(x, y) which is at [0, 1] and [1, 0] cells
-            return np.cov(self.ir_samples[[lag, lag + Delta], :])[0, 1]
+    def convolve_with_n_vec_approx(self, n_vec: NDArray[(Any,), int]) -> NDArray[(Any,), float]:
+        """Fast approximate alternative to RandomizedIr.convolve_with_n_vec for long signals. Signal is modelled as
+        the mean IR convolution (FFT overlap-add) plus a correction term: n deltas in a bin contribute to the next
+        L + 1 bins a gaussian vector with zero mean and covariance n * ir_sample_cov (CLT for a sum of their effects).
+        Mean and covariance of the result are exactly C_mat @ n_vec and Sigma from Xi_mat, but cost is O(N * L)
+        regardless of the number of deltas.
 
+        Args:
+            n_vec (NDArray): number of delta functions in each bin, may be longer than N
+
+        Returns:
+            NDArray: modelled signal of length n_vec.size + L
+        """
+        N = n_vec.size
         L = self.L
-        Xi_mat = np.zeros((L + 1, L + 1))
-        for i in range(L + 1):
-            for j in range(i, L + 1):
-                Xi_mat[i, j] = xi(L - j, i)
+        mean_s_vec = oaconvolve(n_vec.astype(float), self.ir_sample_mean)
 
-        return Xi_mat
+        # ir_sample_cov = A @ A.T; eigendecomposition is used instead of Cholesky as it may be degenerate
+        eigenvalues, eigenvectors = np.linalg.eigh(self.ir_sample_cov)
+        A = eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+        correction_by_bin = (A @ rng.standard_normal(size=(L + 1, N))) * np.sqrt(n_vec)
+        correction = np.zeros((N + L,))
+        for lag in range(L + 1):
+            correction[lag : lag + N] += correction_by_bin[lag, :]  # noqa
+        return mean_s_vec + correction
 
     def estimate_n_vec(self, s_vec: NDArray[(Any,), float], delta: Optional[float] = None) -> NDArray[(Any,), float]:
         """LLS-based estimation of n vector using Moore-Penrose pseudoinverse matrix.
@@ -258,28 +1145,67 @@ class RandomizedIrEffect:
             s_vec += delta / 2
         return np.abs(self.C_mat_pinv @ s_vec)
 
+    def estimate_n_mat(
+        self,
+        s_mat: NDArray[(Any, Any), float],
+        delta: Union[float, NDArray[(Any,), float], None] = None,
+        regularization: float = 1e-3,
+        max_iter: int = 2000,
+        tol: float = 1e-7,
+    ) -> NDArray[(Any, Any), float]:
+        """Non-negative least squares estimation of n vectors for a batch of signals, e.g. all channels of a frame.
+        Solves min ||C_mat @ n - s||^2 + lambda ||n||^2 subject to n >= 0 for all signals at once with accelerated
+        projected gradient (FISTA with adaptive restart), starting from clipped pseudoinverse solution. C_mat has
+        L-dimensional null space, so small ridge term is used to select minimum-norm solution (like pseudoinverse
+        does in estimate_n_vec) and make convergence fast.
+
+        Args:
+            s_mat (NDArray[(Any, Any), float]): signals stacked as (n_signals, N) matrix
+            delta (Union[float, NDArray[(Any,), float], None], optional): ADC rounding step, common or one per signal;
+                if passed, box midpoints are fitted as in estimate_n_vec. Defaults to None.
+            regularization (float, optional): lambda relative to the largest eigenvalue of C_mat.T @ C_mat.
+                Defaults to 1e-3.
+            max_iter (int, optional): maximum number of iterations. Defaults to 2000.
+            tol (float, optional): relative change of n vectors to stop at. Defaults to 1e-7.
+
+        Returns:
+            NDArray[(Any, Any), float]: (n_signals, N) matrix of estimated n vectors
+        """
+        s_mat = utils.slice_edge_effects(np.atleast_2d(s_mat), self.L, self.N, axis=1)
+        if delta is not None:
+            s_mat = s_mat + np.reshape(delta, (-1, 1)) / 2
+        gram = self.C_mat.T @ self.C_mat
+        gram_max_eigval = np.linalg.eigvalsh(gram)[-1]
+        gram += regularization * gram_max_eigval * np.eye(self.N)
+        Cs_mat = s_mat @ self.C_mat
+        step = 1 / ((1 + regularization) * gram_max_eigval)  # 1 / Lipschitz constant of the gradient
+
+        n_mat = np.clip(s_mat @ self.C_mat_pinv.T, 0, None)
+        y_mat = n_mat.copy()
+        t = np.ones((n_mat.shape[0], 1))
+        for _ in range(max_iter):
+            n_mat_prev = n_mat
+            n_mat = np.clip(y_mat - step * (y_mat @ gram - Cs_mat), 0, None)
+            t_prev = t
+            t = (1 + np.sqrt(1 + 4 * t ** 2)) / 2
+            # momentum is reset for signals where it points against the projected gradient step
+            is_restarted = np.sum((y_mat - n_mat) * (n_mat - n_mat_prev), axis=1, keepdims=True) > 0
+            t[is_restarted] = 1.0
+            momentum = np.where(is_restarted, 0.0, (t_prev - 1) / t)
+            y_mat = n_mat + momentum * (n_mat - n_mat_prev)
+            change = np.linalg.norm(n_mat - n_mat_prev, axis=1) / np.maximum(np.linalg.norm(n_mat, axis=1), 1.0)
+            if np.max(change) < tol:
+                break
+        return n_mat
+
     def get_mvn_mu_Sigma_from_n_vec(self):
         L = self.L
         N = self.N
         C_mat = self.C_mat
         Xi_mat = self.Xi_mat
 
-        # extracting it as njitted function
-        @njit
         def mu_Sigma(n_vec: NDArray[(Any,), float]):
-            # mean vector calculation
-            mu = C_mat @ n_vec
-            # covariance matrix calculation
-            Sigma = np.zeros((N - L, N - L))
-            for i_cut in range(N - L):
-                i = i_cut + L + 1
-                # see \\ref{eq:Xi-matrix-for-Sigma-calculation}
-                Sigma_i_vec = Xi_mat @ n_vec[i_cut:i]  # noqa
-                # cutting end of Sigma_i vec when adding it at the end of the matrix (no effect on the inside-region)
-                Sigma_i_vec = Sigma_i_vec[: N - L - i_cut]
-                Sigma[i_cut, i_cut:i] = Sigma_i_vec
-                Sigma[i_cut:i, i_cut] = Sigma_i_vec
-            return mu, Sigma
+            return mvn_mu_Sigma_kernel(n_vec, C_mat, Xi_mat, L, N)
 
         return mu_Sigma
 
@@ -289,9 +1215,24 @@ class RandomizedIrEffect:
         delta: float,
         density: bool = False,
         debug_integration: bool = False,
+        integration: str = 'qmc',
     ) -> Callable[[NDArray[(Any,), float]], float]:
-        """Loglikelihood function for a given signal s_vec assuming independent and normal distributions of S_j"""
+        """Loglikelihood function for a given signal s_vec assuming independent and normal distributions of S_j
+
+        If not density, probability of ADC box [s_vec, s_vec + delta] is integrated with method given by
+        `integration`: 'qmc' (mvn_extension.integrate_pdf_qmc), 'mc' (integrate_pdf_fast), 'mvnun' (integrate_pdf)
+        or 'ghk' (integrate_pdf_ghk)
+        """
         s_vec = utils.slice_edge_effects(s_vec, self.L, self.N)
+        integrate_pdf_by_method = {
+            'qmc': mvn_extension.integrate_pdf_qmc,
+            'mc': mvn_extension.integrate_pdf_fast,
+            'mvnun': mvn_extension.integrate_pdf,
+            'ghk': mvn_extension.integrate_pdf_ghk,
+        }
+        if integration not in integrate_pdf_by_method:
+            raise ValueError(f"Unknown integration method '{integration}'")
+        integrate_pdf = integrate_pdf_by_method[integration]
 
         # see https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.multivariate_normal.html
         mvn_params_default = {
@@ -308,57 +1249,213 @@ class RandomizedIrEffect:
             if density:
                 return rv.logpdf(s_vec)
             else:
-                # TEMPORARY #
+                return np.log(integrate_pdf(rv, s_vec, delta, debug=debug_integration))
 
-                # alan = mvn_extension.integrate_pdf(rv, s_vec, delta)
-                # mc = mvn_extension.integrate_pdf_fast(rv, s_vec, delta)
-                # print(f"{alan}\t{mc}")
-                # alan_mc.append([alan, mc])
-                # print(f"alan > mc: {100 * np.abs(alan - mc) / (0.5 * (alan + mc)):.2f} %")
+        return loglikelihood_mvn
 
-                #############
-                return np.log(mvn_extension.integrate_pdf_fast(rv, s_vec, delta, debug=debug_integration))
-                # return np.log(mvn_extension.integrate_pdf(rv, s_vec, delta, debug=debug_integration))
+    def get_loglikelihood_mvn_banded(
+        self,
+        s_vec: NDArray[(Any,), float],
+        delta: float,
+        density: bool = False,
+        ghk_samples: Optional[int] = 256,
+    ) -> Callable[[NDArray[(Any,), float]], float]:
+        """Compiled equivalent of get_loglikelihood_mvn: Sigma is assembled in band form and factorized with banded
+        Cholesky in O(N * L^2) instead of building dense scipy distribution.
 
-        return loglikelihood_mvn
+        If not density, probability of the ADC box [s_vec, s_vec + delta] is estimated with GHK algorithm
+        (see banded_mvn.ghk_log_box_probability) from `ghk_samples` sequential samples. They are driven by a fixed
+        randomly shifted low-discrepancy stream, i.e. common random numbers are used across calls and likelihood
+        surface is smooth. If ghk_samples is None, box probability is approximated with midpoint rule."""
+        s_vec = utils.slice_edge_effects(s_vec, self.L, self.N)
+        uniforms = self._ghk_uniforms(s_vec.size, None if density else ghk_samples)
+        L = self.L
+        N = self.N
+        C_mat = self.C_mat
+        Xi_mat = self.Xi_mat
+
+        def loglikelihood_mvn_banded(n_vec: NDArray[(Any,), float]) -> float:
+            return loglikelihood_mvn_banded_kernel(n_vec, s_vec, delta, density, uniforms, C_mat, Xi_mat, L, N)
+
+        return loglikelihood_mvn_banded
+
+    def get_loglikelihood_mvn_banded_value_and_grad(
+        self,
+        s_vec: NDArray[(Any,), float],
+        delta: float,
+        density: bool = False,
+    ) -> Callable[[NDArray[(Any,), float]], Tuple[float, NDArray[(Any,), float]]]:
+        """Like get_loglikelihood_mvn_banded with ghk_samples=None, but returned function gives a tuple of
+        log-likelihood and its exact gradient w.r.t. n_vec, for gradient-based optimizers and samplers. GHK
+        estimate is not differentiable, so box probability is always approximated with midpoint rule."""
+        s_vec = utils.slice_edge_effects(s_vec, self.L, self.N)
+        L = self.L
+        N = self.N
+        C_mat = self.C_mat
+        Xi_mat = self.Xi_mat
+
+        def loglikelihood_mvn_banded_value_and_grad(n_vec: NDArray[(Any,), float]) -> Tuple[float, NDArray]:
+            return loglikelihood_mvn_banded_value_and_grad_kernel(n_vec, s_vec, delta, density, C_mat, Xi_mat, L, N)
+
+        return loglikelihood_mvn_banded_value_and_grad
+
+    def get_loglikelihood_mvn_batch(
+        self,
+        s_vec: NDArray[(Any,), float],
+        delta: float,
+        density: bool = False,
+        ghk_samples: Optional[int] = 256,
+    ) -> Callable[[NDArray[(Any, Any), float]], NDArray[(Any,), float]]:
+        """Batch version of get_loglikelihood_mvn_banded: returned function takes stacked n_vecs (W, N), e.g.
+        positions of all MCMC walkers, and returns W log-likelihoods computed in parallel. Can be passed to
+        emcee.EnsembleSampler with vectorize=True."""
+        s_vec = utils.slice_edge_effects(s_vec, self.L, self.N)
+        uniforms = self._ghk_uniforms(s_vec.size, None if density else ghk_samples)
+        L = self.L
+        N = self.N
+        C_mat = self.C_mat
+        Xi_mat = self.Xi_mat
+
+        def loglikelihood_mvn_batch(n_mat: NDArray[(Any, Any), float]) -> NDArray[(Any,), float]:
+            return loglikelihood_mvn_banded_batch_kernel(n_mat, s_vec, delta, density, uniforms, C_mat, Xi_mat, L, N)
+
+        return loglikelihood_mvn_batch
+
+    @staticmethod
+    def _ghk_uniforms(dim: int, ghk_samples: Optional[int]) -> NDArray[(Any, Any), float]:
+        """Randomly shifted Kronecker sequence, fixed for the lifetime of a likelihood; empty for midpoint rule"""
+        if ghk_samples is None:
+            return np.zeros((0, dim))
+        return (mvn_extension.kronecker_points(ghk_samples, dim) + rng.random(size=dim)) % 1
+
+    SAMPLE_S_VEC_PROGRESS_CHUNKSIZE = 10 ** 4
 
     def sample_S_vec(
-        self, n_vec: NDArray[(Any,), float], n_samples: int, progress: bool = False
+        self,
+        n_vec: NDArray[(Any,), float],
+        n_samples: int,
+        progress: bool = False,
+        edge_effects_sliced: bool = False,
+        out: Optional[NDArray[(Any, Any), float]] = None,
+        dtype: type = np.float64,
     ) -> NDArray[(Any, Any), float]:
-        """Generate sample of sigmal realizations for a given input n_vec"""
-        n_vec = n_vec.round().astype(int)
-        N = n_vec.size
+        """Generate sample of sigmal realizations for a given input n_vec, one realization per column.
 
-        S_length = N + self.L
+        Realizations are generated in parallel by compiled sample_S_vec_iid, IR realizations are drawn from ir_pool.
 
-        n_ir_samples = self.ir_samples.shape[1]
-        s_sample = np.zeros((S_length, n_samples))
+        Args:
+            n_vec (NDArray[(N,), float]): photoelectron counts, rounded to integers
+            n_samples (int): number of realizations
+            progress (bool): show progress bar, generating sample in chunks
+            edge_effects_sliced (bool): generate only bins L, ..., N-1 (see utils.slice_edge_effects)
+            out (NDArray[(n_samples, bins count), float], optional): preallocated buffer to avoid allocations
+            dtype (type): type of the output created if out is not given; np.float32 halves memory consumption
 
-        sample_indices = range(n_samples)
+        Returns:
+            NDArray[(bins count, n_samples), float]: sample; transposed view of out buffer
+        """
+        n_vec, start, out = self._prepare_S_sample(n_vec, n_samples, edge_effects_sliced, out, dtype)
+        chunk_starts = range(0, n_samples, self.SAMPLE_S_VEC_PROGRESS_CHUNKSIZE if progress else max(n_samples, 1))
         if progress:
-            sample_indices = tqdm_notebook(sample_indices)
-
-        for s_sample_index in sample_indices:
-            ir_sample_choice = self.ir_samples[:, np.random.choice(np.arange(n_ir_samples), size=(n_vec.sum(),))]
-            s_modelled = np.zeros((S_length,))
-            ir_sample_index_offset = 0
-            for i, n in enumerate(n_vec):
-                s_modelled[i : i + self.L + 1] += np.sum(  # noqa
-                    ir_sample_choice[:, ir_sample_index_offset : ir_sample_index_offset + n], axis=1  # noqa
-                )
-                ir_sample_index_offset += n
-            s_sample[:, s_sample_index] = s_modelled
-        return s_sample
+            chunk_starts = tqdm_notebook(chunk_starts)
+        for chunk_start in chunk_starts:
+            chunk_stop = chunk_start + (self.SAMPLE_S_VEC_PROGRESS_CHUNKSIZE if progress else n_samples)
+            sample_S_vec_iid(self.ir_pool, n_vec, start, out[chunk_start:chunk_stop])
+        return out.T
+
+    @cached_property
+    def ir_pool(self) -> NDArray[(Any, Any), float]:
+        """IR samples as a contiguous pool of realizations, one per row, for sample_S_vec_crn"""
+        self._check_ir_samples_stored()
+        return np.ascontiguousarray(self.ir_samples.T)
+
+    def sample_S_vec_crn(
+        self,
+        n_vec: NDArray[(Any,), float],
+        n_samples: int,
+        seed: int = 0,
+        sample_offset: int = 0,
+        edge_effects_sliced: bool = False,
+        out: Optional[NDArray[(Any, Any), float]] = None,
+    ) -> NDArray[(Any, Any), float]:
+        """Same as sample_S_vec, but with common random numbers (see module-level sample_S_vec_crn): the same seed and
+        sample indices give the same IR draws for every n_vec, so likelihood estimated from the sample is a smooth
+        function of n_vec.
+
+        See sample_S_vec for the rest of arguments."""
+        n_vec, start, out = self._prepare_S_sample(n_vec, n_samples, edge_effects_sliced, out, np.float64)
+        sample_S_vec_crn(self.ir_pool, n_vec, seed, sample_offset, start, out)
+        return out.T
 
-    def get_loglikelihood_monte_carlo(self, s_vec: NDArray[(Any,), float]) -> Callable[[NDArray[(Any,), float]], float]:
+    def _prepare_S_sample(
+        self,
+        n_vec: NDArray[(Any,), float],
+        n_samples: int,
+        edge_effects_sliced: bool,
+        out: Optional[NDArray[(Any, Any), float]],
+        dtype: type,
+    ):
+        n_vec = n_vec.round().astype(int)
+        N = n_vec.size
+        start, stop = (self.L, N) if edge_effects_sliced else (0, N + self.L)
+        if out is None:
+            out = np.empty((n_samples, stop - start), dtype=dtype)
+        elif out.shape != (n_samples, stop - start):
+            raise ValueError(f"out buffer must be of shape {(n_samples, stop - start)}, got {out.shape}")
+        return n_vec, start, out
+
+    def get_loglikelihood_monte_carlo(
+        self,
+        s_vec: NDArray[(Any,), float],
+        target_cell_count: Optional[int] = None,
+        chunksize: int = 10 ** 5,
+        max_samplesize: int = 10 ** 7,
+        common_random_numbers: bool = False,
+    ) -> Callable[[NDArray[(Any,), float]], float]:
+        """Likelihood as empirical PDF of modelled signal sample at s_vec.
+
+        By default sample of fixed size 10^6 is generated for each n_vec. If target_cell_count is given, sample is
+        generated in chunks of chunksize and binned incrementally on the grid fixed by the first chunk, until s_vec's
+        cell contains target_cell_count points or sample size reaches max_samplesize.
+
+        If common_random_numbers is True, sample is drawn with sample_S_vec_crn with a seed fixed for the lifetime of
+        the likelihood into a preallocated buffer, so that evaluation is a gather-and-sum over the pool of IR samples
+        and likelihood surface is not noisy, which makes it usable in MCMC."""
         L = self.L
         N = s_vec.size - L
         center_s_vec = s_vec[L:N]
+        center_s_point = center_s_vec.reshape(-1, 1)
+
+        if common_random_numbers:
+            self._check_ir_samples_stored()
+            seed = int(rng.integers(np.iinfo(np.int64).max))
+            sample_buffer = np.empty((10 ** 6 if target_cell_count is None else chunksize, N - L))
+
+        def draw_s_sample(n_vec: NDArray[(Any,), float], size: int, sample_offset: int, progress: bool):
+            if common_random_numbers:
+                return self.sample_S_vec_crn(
+                    n_vec, size, seed, sample_offset, edge_effects_sliced=True, out=sample_buffer[:size]
+                )
+            else:
+                return self.sample_S_vec(n_vec, size, progress=progress, edge_effects_sliced=True)
 
         def loglikelihood_monte_carlo(n_vec: NDArray[(Any,), float], progress: bool = False) -> float:
-            s_sample = self.sample_S_vec(n_vec, 10 ** 6, progress=progress)
-            s_sample = utils.slice_edge_effects(s_sample, L, N)
-            return np.log(ndepdf(s_sample, center_s_vec, bins=5, check_bin_count=True))
+            if target_cell_count is None:
+                s_sample = draw_s_sample(n_vec, 10 ** 6, 0, progress)
+                return np.log(ndepdf(s_sample, center_s_vec, bins=5, check_bin_count=True))
+
+            index = None
+            while index is None or index.sample_size < max_samplesize:
+                s_sample = draw_s_sample(n_vec, chunksize, 0 if index is None else index.sample_size, progress)
+                if index is None:
+                    index = EmpiricalDensityIndex.from_sample(s_sample, bins=5)
+                    if not index.covers(center_s_point)[0]:
+                        return -np.inf
+                else:
+                    index.add(s_sample)
+                if index.cell_counts(center_s_point)[0] >= target_cell_count:
+                    break
+            return np.log(index.pdf(center_s_point)[0])
 
         return loglikelihood_monte_carlo
 
@@ -369,52 +1466,175 @@ class RandomizedIrEffect:
         density: False,
     ) -> Callable[[NDArray[(Any,), float]], float]:
         """Like get_loglikelihood_uncorrelated_mvn, but with verbatim calculations and njitted efficient function"""
+        L = self.L
+        ir_sample_mean = self.ir_sample_mean
+        ir_sample_D = self.ir_sample_D
 
+        def loglikelihood_normdist(n_vec: NDArray[(Any,), float]) -> float:
+            return loglikelihood_normdist_kernel(n_vec, s_vec, delta, density, ir_sample_mean, ir_sample_D, L)
+
+        return loglikelihood_normdist
+
+    def get_loglikelihood_independent_normdist_value_and_grad(
+        self,
+        s_vec: NDArray[(Any,), float],
+        delta: float,
+        density: bool = False,
+    ) -> Callable[[NDArray[(Any,), float]], Tuple[float, NDArray[(Any,), float]]]:
+        """Like get_loglikelihood_independent_normdist, but returned function gives a tuple of log-likelihood and its
+        exact gradient w.r.t. n_vec"""
         L = self.L
-        N = s_vec.size - L
-        # for nested function to be numbifiable
         ir_sample_mean = self.ir_sample_mean
         ir_sample_D = self.ir_sample_D
 
-        @njit
-        def norm_cdf(x, mu, sigma):
-            return 0.5 * (1 + erf((x - mu) / (sigma * 1.41421356237)))
+        def loglikelihood_normdist_value_and_grad(n_vec: NDArray[(Any,), float]) -> Tuple[float, NDArray]:
+            return loglikelihood_normdist_value_and_grad_kernel(
+                n_vec, s_vec, delta, density, ir_sample_mean, ir_sample_D, L
+            )
 
-        norm_cdf(0, 0, 1)  # do the jitting right away
+        return loglikelihood_normdist_value_and_grad
 
-        @njit
-        def loglikelihood_normdist(n_vec: NDArray[(Any,), float]) -> float:
-            if np.any(n_vec < 0):  # guard for impossible values
-                return -np.inf
-            logL = 0
-            for j, s_j in enumerate(s_vec):
-                j += 1  # from indexing array (0-based) to indexing time points (1-based)
-                if j <= L or j > N:  # cutting off signal edges
-                    continue
-                Es_j = 0
-                Ds_j = 0
-                for lag in range(L + 1):
-                    i = j - lag
-                    i -= 1  # from indexing bins (1-based) to indexing array (0-based)
-                    Es_j += n_vec[i] * ir_sample_mean[lag]
-                    Ds_j += n_vec[i] * ir_sample_D[lag]
-                sigma_s_j = np.sqrt(Ds_j)
-                if density:
-                    logL_addition = (
-                        -0.918938533205  # log(sqrt(2 pi))
-                        - np.log(sigma_s_j)
-                        - ((s_j - Es_j) / (1.41421356237 * sigma_s_j)) ** 2
-                    )
-                else:
-                    logL_addition = np.log(
-                        norm_cdf(s_j + delta, mu=Es_j, sigma=sigma_s_j) - norm_cdf(s_j, mu=Es_j, sigma=sigma_s_j)
-                    )
-                if np.isnan(logL_addition):
-                    return -np.inf
-                logL += logL_addition
-            return logL
+    def get_loglikelihood_independent_normdist_batch(
+        self,
+        s_vec: NDArray[(Any,), float],
+        delta: float,
+        density: bool = False,
+    ) -> Callable[[NDArray[(Any, Any), float]], NDArray[(Any,), float]]:
+        """Walker-vectorized get_loglikelihood_independent_normdist: returned function takes stacked n_vecs (W, N)
+        and returns W log-likelihoods from one compiled call, parallel over walkers (number of threads is controlled
+        with numba.set_num_threads). Can be used with emcee.EnsembleSampler with vectorize=True,
+        see mcmc.SamplingConfig.vectorize."""
+        L = self.L
+        ir_sample_mean = self.ir_sample_mean
+        ir_sample_D = self.ir_sample_D
 
-        return loglikelihood_normdist
+        def loglikelihood_normdist_batch(n_mat: NDArray[(Any, Any), float]) -> NDArray[(Any,), float]:
+            return loglikelihood_normdist_batch_kernel(n_mat, s_vec, delta, density, ir_sample_mean, ir_sample_D, L)
+
+        return loglikelihood_normdist_batch
+
+    def get_loglikelihood_edgeworth(
+        self,
+        s_vec: NDArray[(Any,), float],
+        delta: float,
+        density: bool = False,
+    ) -> Callable[[NDArray[(Any,), float]], float]:
+        """Like get_loglikelihood_independent_normdist, but distribution of each S_j is approximated with Edgeworth
+        expansion using its 3rd and 4th cumulants, which are sums of n_i times per-lag cumulants from ir_cumulants.
+        This accounts for skewness of S_j at low photoelectron counts at the cost of normdist likelihood.
+
+        Truncated expansion is not a proper density and may give non-positive probability in the tails of S_j. For
+        such terms normal approximation (as in get_loglikelihood_independent_normdist) is used instead, so the
+        result is a mixture of two models: it is continuous in n_vec only where the expansion stays positive, and
+        tail terms are not comparable between Edgeworth and normal branches. Log-likelihood is -inf if some S_j has
+        zero variance, i.e. all n_i in its lag window are zero."""
+        if self.ir_cumulants.shape[0] < 3:
+            raise ValueError("Edgeworth expansion requires cumulants of at least 3rd order")
+        L = self.L
+        # 4th cumulant is assumed zero if it is not available
+        ir_cumulants = np.zeros((MAX_CUMULANT_ORDER, L + 1))
+        ir_cumulants[: self.ir_cumulants.shape[0]] = self.ir_cumulants
+
+        def loglikelihood_edgeworth(n_vec: NDArray[(Any,), float]) -> float:
+            return loglikelihood_edgeworth_kernel(n_vec, s_vec, delta, density, ir_cumulants, L)
+
+        return loglikelihood_edgeworth
+
+    # MAP / Laplace approximation
+
+    def get_laplace_approximation(
+        self,
+        s_vec: NDArray[(Any,), float],
+        delta: float,
+        density: bool = False,
+        likelihood: str = 'mvn',
+        init_point: Optional[NDArray[(Any,), float]] = None,
+        hessian_step: float = 1e-4,
+    ) -> LaplaceApproximation:
+        """Find posterior mode of n_vec (flat prior, n >= 0) and approximate posterior with normal distribution
+        around it, truncated to n >= 0. Much faster than MCMC for quick-look results.
+
+        Covariance is the inverse negative Hessian of log-likelihood at the mode, regularized with a weak independent
+        normal prior with variance max(n_i, 1) in each bin: first L bins are only partially seen in the signal and
+        the likelihood is (nearly) flat along some of their combinations. Hessian is calculated only over free bins;
+        bins where the mode is at n = 0 bound are treated as one-sided and independent, with normal approximation
+        built from the log-likelihood slope and curvature at the bound.
+
+        Args:
+            s_vec (NDArray[(Any,), float]): signal
+            delta (float): ADC rounding step
+            density (bool, optional): see get_loglikelihood_independent_normdist. Defaults to False.
+            likelihood (str, optional): 'mvn' for get_loglikelihood_mvn_banded_value_and_grad or 'normdist' for
+                get_loglikelihood_independent_normdist_value_and_grad. Defaults to 'mvn'.
+            init_point (Optional[NDArray[(Any,), float]], optional): starting point for the optimizer, by default
+                estimate_n_vec is used.
+            hessian_step (float, optional): relative step for Hessian calculation as finite differences of the
+                analytic gradient. Defaults to 1e-4.
+
+        Returns:
+            LaplaceApproximation: mode, normal approximation parameters and log-likelihood at the mode
+        """
+        if likelihood == 'mvn':
+            value_and_grad = self.get_loglikelihood_mvn_banded_value_and_grad(s_vec, delta, density)
+        elif likelihood == 'normdist':
+            value_and_grad = self.get_loglikelihood_independent_normdist_value_and_grad(s_vec, delta, density)
+        else:
+            raise ValueError(f"Unknown likelihood '{likelihood}', must be 'mvn' or 'normdist'")
+        if init_point is None:
+            init_point = self.estimate_n_vec(s_vec, delta)
+
+        def neg_loglike_and_grad(n_vec):
+            logL, grad = value_and_grad(n_vec)
+            if not np.isfinite(logL):
+                # big finite value makes line search backtrack instead of failing on inf
+                return 1e300, np.zeros_like(n_vec)
+            return -logL, -grad
+
+        # strictly positive lower bound: covariance is degenerate if all n_i in a window are zero
+        min_n = 1e-9
+        result = minimize(
+            neg_loglike_and_grad,
+            np.clip(init_point, min_n, None),
+            jac=True,
+            method='L-BFGS-B',
+            bounds=[(min_n, None)] * self.N,
+        )
+        mode = result.x
+        if not np.isfinite(result.fun) or result.fun >= 1e300:
+            raise ValueError(f"Posterior mode search failed: {result.message}")
+
+        is_free = mode > 2 * min_n
+        free = np.flatnonzero(is_free)
+        bound = np.flatnonzero(~is_free)
+        grad_at_mode = value_and_grad(mode)[1]
+        prior_precision = 1 / np.maximum(mode, 1.0)
+
+        # Hessian of log-likelihood over free bins as central differences of analytic gradient, kept inside n >= 0
+        hessian = np.zeros((free.size, free.size))
+        for i_free, i in enumerate(free):
+            h = hessian_step * max(mode[i], 1.0)
+            step_down = min(h, mode[i] - min_n)
+            n_up = mode.copy()
+            n_up[i] += h
+            n_down = mode.copy()
+            n_down[i] -= step_down
+            hessian[:, i_free] = (value_and_grad(n_up)[1][free] - value_and_grad(n_down)[1][free]) / (h + step_down)
+        hessian = 0.5 * (hessian + hessian.T)
+        eigvals, eigvecs = np.linalg.eigh(-hessian + np.diag(prior_precision[free]))
+        # non-log-concave directions get the weakest prior curvature
+        eigvals = np.clip(eigvals, np.min(prior_precision), None)
+
+        cov = np.zeros((self.N, self.N))
+        cov[np.ix_(free, free)] = (eigvecs / eigvals) @ eigvecs.T
+        loc = mode.copy()
+        # bins at the bound: log-likelihood ~ slope * n - curvature * n^2 / 2 for n >= 0, forward differences
+        for i in bound:
+            n_up = mode.copy()
+            n_up[i] += hessian_step
+            curvature = max(-(value_and_grad(n_up)[1][i] - grad_at_mode[i]) / hessian_step, 0.0) + prior_precision[i]
+            cov[i, i] = 1 / curvature
+            loc[i] = mode[i] + grad_at_mode[i] / curvature
+        return LaplaceApproximation(mode=mode, cov=cov, loglike_at_mode=-result.fun, loc=loc)
 
     # MGF calculation methods
 
@@ -435,15 +1655,22 @@ class RandomizedIrEffect:
         """mgf for n = 1"""
         MGF_EPSILON = 1e-7
 
+        self._check_ir_samples_stored()
         if abs(t) < MGF_EPSILON:
             return 1
         else:
             return np.mean(np.exp(t * self.ir_samples[lag, :]))
 
-    @lru_cache(maxsize=100000)
     def mgf_moment(self, i: int, n: int, lag: int) -> float:
-        """Compute ith moment of C(n, lag) using MGF"""
-
+        """Compute ith raw moment of C(n, lag).
+
+        For i up to the order of cumulants table, moment is exact: cumulants of the sum of n independent contributions
+        are n times cumulants of a single one, ir_cumulants[:, lag]. Higher moments are calculated by numerical
+        differentiation of MGF, which requires stored ir_samples."""
+        if i == 0:
+            return 1.0
+        if i <= self.ir_cumulants.shape[0]:
+            return raw_moments_from_cumulants(n * self.ir_cumulants[:i, lag])[i - 1]
         derivative = nd.Derivative(partial(self.mgf, n=n, lag=lag), n=i, full_output=True)
         moment, info = derivative(0)
         return moment
@@ -451,6 +1678,7 @@ class RandomizedIrEffect:
     # diagnostic plots
 
     def plot_samples(self, max_lag: int = None):
+        self._check_ir_samples_stored()
         if max_lag is None:
             max_lag = self.ir_samples.shape[0]
         fig, ax = plt.subplots(figsize=(8, 7))
@@ -469,6 +1697,7 @@ class RandomizedIrEffect:
         plt.show()
 
     def plot_moments(self, n: int, lag: int):
+        self._check_ir_samples_stored()
         fig, ax = plt.subplots(figsize=(8, 7))
 
         sample_1 = self.ir_samples[lag, :]
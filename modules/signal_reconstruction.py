@@ -2,6 +2,8 @@
 Loglikelihood and initial point for MCMC-based signal-noise separation
 """
 
+from __future__ import annotations
+
 import numpy as np
 from numba import njit
 
@@ -59,6 +61,41 @@ def get_logprior(signal_sample: SignalSample, signal_t: Signal, mean_n_phels: fl
     return logprior
 
 
+@njit(cache=True)
+def signal_reconstruction_loglike(
+    theta: NDArray[(3,), float],
+    signal_sample: SignalSample,
+    bin_edges: NDArray[(Any,), int],
+    t_first_bin: float,
+    mean_n_phels: float,
+    simulate_packets: bool,
+) -> float:
+    """See get_signal_reconstruction_loglike; compiled once for all signals and cached on disk"""
+    n_eas, t_mean, sigma_t = theta
+    t_relative = t_mean - t_first_bin
+    samplesize = signal_sample.shape[0]
+    n_eas_per_bin = np.zeros(signal_sample.shape)
+    if not simulate_packets:
+        cdf_at_bin_edges = utils.norm_cdf(bin_edges, mu=t_relative, sigma=sigma_t)
+        n_eas_per_bin[:, :] = n_eas * np.diff(cdf_at_bin_edges)  # diff(cdf) gives probabilities in bins
+    else:
+        packets = np.random.normal(loc=t_relative, scale=sigma_t, size=(samplesize, int(n_eas)))
+        for i_sample in range(samplesize):
+            n_eas_per_bin[i_sample, :] = np.histogram(packets[i_sample, :], bins=bin_edges)[0]
+    only_noise_sample = signal_sample - n_eas_per_bin
+
+    pmfs = utils.poisson_pmf(only_noise_sample, lmb=mean_n_phels)
+
+    log_p = 0
+    for pmf_in_bin in pmfs.T:
+        log_p += np.log(np.mean(pmf_in_bin))
+    # p_mean = 0
+    # for pmf_rlz in pmfs:
+    #     p_mean += np.prod(pmf_rlz)
+    # log_p = np.log(p_mean / pmf_rlz.shape[0])
+    return log_p if not np.isnan(log_p) else -np.inf
+
+
 def get_signal_reconstruction_loglike(
     signal_sample: SignalSample,
     signal_t: Signal,
@@ -68,34 +105,11 @@ def get_signal_reconstruction_loglike(
 ):
     t_first_bin = signal_t[0] - 1
     bin_edges = np.arange(signal_sample.shape[1] + 1)
-    samplesize, N = signal_sample.shape
+    signal_sample = np.ascontiguousarray(signal_sample, dtype=float)
+    kernel = signal_reconstruction_loglike if njitted else signal_reconstruction_loglike.py_func
 
     def loglike(theta):
-        n_eas, t_mean, sigma_t = theta
-        t_relative = t_mean - t_first_bin
-        if not simulate_packets:
-            cdf_at_bin_edges = utils.norm_cdf(bin_edges, mu=t_relative, sigma=sigma_t)
-            n_eas_per_bin = n_eas * np.diff(cdf_at_bin_edges)  # diff(cdf) gives probabilities in bins
-        else:
-            packets = np.random.normal(loc=t_relative, scale=sigma_t, size=(samplesize, int(n_eas)))
-            n_eas_per_bin = np.zeros_like(signal_sample, dtype='int')
-            for i_sample in range(samplesize):
-                n_eas_per_bin[i_sample, :] = np.histogram(packets[i_sample, :], bins=bin_edges)[0]
-        only_noise_sample = signal_sample - n_eas_per_bin
-
-        pmfs = utils.poisson_pmf(only_noise_sample, lmb=mean_n_phels)
-
-        log_p = 0
-        for pmf_in_bin in pmfs.T:
-            log_p += np.log(np.mean(pmf_in_bin))
-        # p_mean = 0
-        # for pmf_rlz in pmfs:
-        #     p_mean += np.prod(pmf_rlz)
-        # log_p = np.log(p_mean / pmf_rlz.shape[0])
-        return log_p if not np.isnan(log_p) else -np.inf
-
-    if njitted:
-        loglike = njit(loglike)
+        return kernel(theta, signal_sample, bin_edges, t_first_bin, mean_n_phels, simulate_packets)
 
     return loglike
 
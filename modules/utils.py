@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import numpy as np
 import timeit
 from functools import wraps
@@ -23,6 +25,28 @@ def slice_edge_effects(mat: NDArray[(Any,), float], L: int, N: int, axis: int =
     return np.take(mat, range(L, N), axis=axis)
 
 
+def interp_columns(x_grid: NDArray[(Any,), float], ys: NDArray[(Any, Any), float], x: NDArray[(Any, Any), float]):
+    """Linear interpolation of each column of ys, sampled at x_grid, at query points from the same column of x.
+    Equivalent to calling interp1d(x_grid, ys[:, i], fill_value=0, bounds_error=False)(x[:, i]) for each column i.
+
+    Args:
+        x_grid (NDArray[(N_grid,), float]): increasing sampling points, common for all columns
+        ys (NDArray[(N_grid, N_batch), float]): stack of sampled functions, one per column
+        x (NDArray[(N_query, N_batch), float]): query points, one column per sampled function
+
+    Returns:
+        NDArray[(N_query, N_batch), float]: interpolated values, zero outside of [x_grid[0], x_grid[-1]]
+    """
+    i_left = np.searchsorted(x_grid, x, side='right') - 1
+    i_left = np.clip(i_left, 0, x_grid.size - 2)
+    columns = np.arange(x.shape[1]).reshape((1, x.shape[1]))
+    x_left = x_grid[i_left]
+    y_left = ys[i_left, columns]
+    y_right = ys[i_left + 1, columns]
+    y = y_left + (x - x_left) * (y_right - y_left) / (x_grid[i_left + 1] - x_left)
+    return np.where(np.logical_and(x >= x_grid[0], x <= x_grid[-1]), y, 0.0)
+
+
 def timer(args_formatter=None):
     if args_formatter is None:
         args_formatter = (
@@ -64,7 +88,7 @@ def enforce_bounds(logprob, n_vec_center, upper_bound_factor: int = 100):
     return bounded_logprob
 
 
-@njit
+@njit(cache=True)
 def norm_cdf(x, mu, sigma):
     cdf = np.zeros_like(x)
     for i, x_i in enumerate(x):
@@ -72,7 +96,7 @@ def norm_cdf(x, mu, sigma):
     return cdf
 
 
-@njit
+@njit(cache=True)
 def poisson_pmf(k: NDArray[(Any), float], lmb: float):
     k_flattened = k.reshape(k.size)
     k_factorial = np.zeros_like(k_flattened)
@@ -0,0 +1,88 @@
+"""
+Analytic log-likelihood gradients checked against central finite differences
+"""
+
+import numpy as np
+import pytest
+
+from modules import banded_mvn
+from modules.randomized_ir import RandomizedIr, RandomizedIrEffect
+
+
+def finite_difference_grad(func, x, h=1e-5):
+    grad = np.zeros_like(x)
+    for i in range(x.size):
+        step = np.zeros_like(x)
+        step[i] = h
+        grad[i] = (func(x + step) - func(x - step)) / (2 * h)
+    return grad
+
+
+def assert_grad_close(grad, grad_fd, rtol=1e-6):
+    assert np.max(np.abs(grad - grad_fd)) <= rtol * np.max(np.abs(grad_fd))
+
+
+@pytest.fixture(scope='module')
+def deconvolution_problem():
+    rng = np.random.default_rng(0)
+    ir_x = np.linspace(0, 3.5, 350)
+    rir = RandomizedIr(ir_x, np.exp(-ir_x), factor=lambda n: 0.5 + rng.random(n) * 0.5)
+    N = 20
+    rireff = RandomizedIrEffect(rir, N, samplesize=10 ** 4)
+    n_true = rng.poisson(8, N)
+    s_vec = rir.convolve_with_n_vec(n_true)
+    n_vec = n_true + rng.uniform(0.5, 2, N)  # off the true point and away from n = 0
+    return rireff, s_vec, n_vec
+
+
+@pytest.mark.parametrize('density', [True, False])
+def test_normdist_grad(deconvolution_problem, density):
+    rireff, s_vec, n_vec = deconvolution_problem
+    value_and_grad = rireff.get_loglikelihood_independent_normdist_value_and_grad(s_vec, delta=0.2, density=density)
+    loglike = rireff.get_loglikelihood_independent_normdist(s_vec, delta=0.2, density=density)
+    value, grad = value_and_grad(n_vec)
+    assert value == pytest.approx(loglike(n_vec), rel=1e-8)
+    assert_grad_close(grad, finite_difference_grad(lambda n: value_and_grad(n)[0], n_vec))
+
+
+@pytest.mark.parametrize('density', [True, False])
+def test_mvn_banded_grad(deconvolution_problem, density):
+    rireff, s_vec, n_vec = deconvolution_problem
+    value_and_grad = rireff.get_loglikelihood_mvn_banded_value_and_grad(s_vec, delta=0.2, density=density)
+    loglike = rireff.get_loglikelihood_mvn_banded(s_vec, delta=0.2, density=density, ghk_samples=None)
+    value, grad = value_and_grad(n_vec)
+    assert value == pytest.approx(loglike(n_vec), rel=1e-10)
+    assert_grad_close(grad, finite_difference_grad(loglike, n_vec))
+
+
+def test_grad_outside_support(deconvolution_problem):
+    rireff, s_vec, n_vec = deconvolution_problem
+    for value_and_grad in (
+        rireff.get_loglikelihood_independent_normdist_value_and_grad(s_vec, delta=0.2),
+        rireff.get_loglikelihood_mvn_banded_value_and_grad(s_vec, delta=0.2),
+    ):
+        value, grad = value_and_grad(-n_vec)
+        assert value == -np.inf
+        assert np.all(grad == 0)
+
+
+def test_banded_logpdf_grad():
+    rng = np.random.default_rng(1)
+    M, p = 12, 3
+    B = np.tril(np.triu(rng.normal(size=(M, M))), p)  # upper banded factor
+    Sigma_band = banded_mvn.to_band(B @ B.T + M * np.eye(M), p)
+    mu = rng.normal(size=M)
+    x = mu + rng.normal(size=M)
+
+    value, grad_mu, grad_Sigma_band = banded_mvn.logpdf_value_and_grad(x, mu, Sigma_band)
+    assert value == pytest.approx(banded_mvn.logpdf(x, mu, Sigma_band), rel=1e-12)
+
+    assert_grad_close(grad_mu, finite_difference_grad(lambda m: banded_mvn.logpdf(x, m, Sigma_band), mu))
+
+    # off-diagonal band entries stand for both symmetric entries of Sigma, so are perturbed in band form directly
+    valid_entries = np.arange(M)[np.newaxis, :] < M - np.arange(p + 1)[:, np.newaxis]
+    grad_Sigma_band_fd = finite_difference_grad(
+        lambda Sigma_band_flat: banded_mvn.logpdf(x, mu, Sigma_band_flat.reshape(Sigma_band.shape)),
+        Sigma_band.reshape(Sigma_band.size),
+    ).reshape(Sigma_band.shape)
+    assert_grad_close(grad_Sigma_band[valid_entries], grad_Sigma_band_fd[valid_entries])
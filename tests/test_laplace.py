@@ -0,0 +1,48 @@
+"""
+Laplace approximation of the posterior checked against NUTS sample on a small problem
+"""
+
+import numpy as np
+import pytest
+
+from modules.nuts import NutsSampler
+from modules.randomized_ir import RandomizedIr, RandomizedIrEffect
+
+
+@pytest.fixture(scope='module')
+def laplace_and_nuts_samples():
+    rng = np.random.default_rng(0)
+    ir_x = np.linspace(0, 3.5, 350)
+    rir = RandomizedIr(ir_x, np.exp(-ir_x), factor=lambda n: 0.5 + rng.random(n) * 0.5)
+    N = 20
+    rireff = RandomizedIrEffect(rir, N, samplesize=10 ** 4)
+    n_true = rng.poisson(15, N)
+    delta = 0.2
+    s_vec = np.floor(rir.convolve_with_n_vec(n_true) / delta) * delta
+
+    laplace = rireff.get_laplace_approximation(s_vec, delta=delta)
+    laplace_sample = laplace.sample(2000, seed=0)
+
+    value_and_grad = rireff.get_loglikelihood_mvn_banded_value_and_grad(s_vec, delta=delta)
+    sampler = NutsSampler(4, N, value_and_grad, n_warmup=300, lower_bound=0, seed=0)
+    for _ in sampler.sample(np.clip(laplace.mode, 1, None) + rng.random((4, N)), iterations=500):
+        pass
+    return rireff.L, laplace_sample, sampler.get_chain(flat=True)
+
+
+def test_laplace_sample_is_non_negative(laplace_and_nuts_samples):
+    _, laplace_sample, _ = laplace_and_nuts_samples
+    assert np.all(laplace_sample >= 0)
+
+
+def test_laplace_marginals_match_nuts(laplace_and_nuts_samples):
+    L, laplace_sample, nuts_sample = laplace_and_nuts_samples
+    nuts_sd = nuts_sample.std(axis=0)
+    sd_ratio = laplace_sample.std(axis=0) / nuts_sd
+    mean_diff = np.abs(laplace_sample.mean(axis=0) - nuts_sample.mean(axis=0)) / nuts_sd
+    # bins away from the signal start are well described by normal approximation
+    assert np.all((0.7 < sd_ratio[2 * L :]) & (sd_ratio[2 * L :] < 1.3))  # noqa
+    assert np.all(mean_diff[2 * L :] < 0.75)  # noqa
+    # bins coupled to the weakly constrained first L bins must not be inflated or biased
+    assert np.all(sd_ratio < 1.5)
+    assert np.all(mean_diff[L : 2 * L] < 3)  # noqa